@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the whole compiler, phase by phase
+
+Generates synthetic stories of growing size (see storygen.py) and compiles
+them in memory with twee2sam.compile_story(), timing each phase with the
+compiler's own profiler (the phases --profile reports). The timings can be
+saved as a baseline and later runs compared against it; any phase that got
+slower than the threshold allows is reported, and the exit status is 1.
+
+    python bench_compile.py --save-baseline
+    python bench_compile.py --sizes 1000 10000 100000
+"""
+
+from __future__ import print_function
+import argparse, io, json, os, platform, sys
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.join(BENCH_PATH, '..')
+sys.path.extend([ROOT_PATH, os.path.join(ROOT_PATH, 'tw'), os.path.join(ROOT_PATH, 'lib')])
+
+import logging
+import twexpression
+import twee2sam
+from storygen import generate_story, add_story_arguments, story_options
+
+BASELINE_PATH = os.path.join(BENCH_PATH, 'baseline.json')
+
+# The phases of the compiler's profiler shown in the table; the total counts them all
+PHASES = ['parse', 'validate', 'plan', 'scripts', 'output']
+
+# Differences below this are considered noise, no matter the threshold
+MIN_DIFFERENCE = 0.01
+
+def compile_timings(source):
+    """Compiles the story the way twee2sam does, in memory, and returns the time spent on each phase"""
+    result = twee2sam.compile_story(source, {'profile': True})
+    if not result.succeeded:
+        raise ValueError('the generated story is broken')
+    return dict((phase['name'], phase['time']) for phase in result.profile['phases'])
+
+def run_benchmark(opts, size):
+    source = generate_story(story_options(opts, passages=size))
+
+    # Keeps the fastest run of each phase
+    best = {}
+    for attempt in range(opts.repeat):
+        # Otherwise, every run after the first would just hit the expression caches
+        twexpression.clear_caches()
+
+        for phase, elapsed in compile_timings(source).items():
+            best[phase] = min(elapsed, best.get(phase, elapsed))
+
+    return best
+
+def compare(results, baseline, threshold):
+    """Lists the (size, phase, baseline, current) of every phase that got slower than the threshold allows"""
+    regressions = []
+    for size, timings in sorted(results.items(), key=lambda item: int(item[0])):
+        previous = baseline.get(size)
+        if previous is None:
+            continue
+        for phase in sorted(timings):
+            if not phase in previous or not phase in timings:
+                continue
+            if timings[phase] > previous[phase] * (1 + threshold) and timings[phase] - previous[phase] > MIN_DIFFERENCE:
+                regressions.append((size, phase, previous[phase], timings[phase]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each phase of the compilation of synthetic stories")
+    add_story_arguments(parser)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    opts = parser.parse_args()
+
+    # The parser warns about every oddity it finds; that's not what's being measured
+    logging.disable(logging.WARNING)
+
+    results = {}
+    print('{0:>8} '.format('passages') + ' '.join('{0:>10}'.format(phase) for phase in PHASES + ['total']))
+    for size in opts.sizes:
+        timings = run_benchmark(opts, size)
+        results[str(size)] = timings
+        print('{0:>8} '.format(size) + ' '.join('{0:>10.3f}'.format(timings.get(phase, 0)) for phase in PHASES) +
+              ' {0:>10.3f}'.format(sum(timings.values())))
+
+    # Timings are only comparable for stories generated the same way
+    story = vars(story_options(opts, passages=None))
+
+    if opts.save_baseline:
+        data = {'python': platform.python_version(), 'story': story, 'timings': results}
+        with io.open(opts.baseline, 'w', encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(data, indent=1, sort_keys=True, separators=(',', ': ')))
+        print('Baseline saved to {0}'.format(opts.baseline))
+        return
+
+    if not os.path.exists(opts.baseline):
+        print('No baseline to compare against; run with --save-baseline to create one')
+        return
+
+    with io.open(opts.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get('python') != platform.python_version():
+        print('Note: the baseline was taken on Python {0}'.format(baseline.get('python')))
+    if baseline.get('story') != story:
+        print('Note: the baseline was taken with different story options: {0}'.format(baseline.get('story')))
+
+    regressions = compare(results, baseline['timings'], opts.threshold)
+    for size, phase, before, after in regressions:
+        print('REGRESSION: {0} passages, {1}: {2:.3f}s -> {3:.3f}s (+{4:.0%})'.format(size, phase, before, after, after / before - 1))
+    if regressions:
+        sys.exit(1)
+    print('No phase is more than {0:.0%} slower than the baseline'.format(opts.threshold))
+
+if __name__ == '__main__':
+    main()
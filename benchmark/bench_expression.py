@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for the expression lexer
+
+Compares how many expressions per second the dedicated lexer parses with
+the old path, which rewrote the operators with str.replace and then ran
+the stdlib tokenize module, checking that both produce the same trees.
+"""
+
+from __future__ import print_function
+import sys, os, timeit, tokenize
+from io import StringIO
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import twexpression
+
+EXPRESSIONS = [
+    u'$started',
+    u'!$brass_lantern',
+    u'not $choseOptionOne',
+    u'$x - 2',
+    u'$gold * 2 + random(6)',
+    u'random(2, 8)',
+    u'-$x % 3',
+    u'true and $q',
+    u'$steps >= 10 && !$tired || $lamp',
+    u'($a + $b) * ($c - 1) / 2 <= $limit'
+]
+
+def legacy_tokens(program):
+    """The old tokenizing path, producing (id, value) tokens"""
+    type_map = {
+        tokenize.NUMBER: "(literal)",
+        tokenize.STRING: "(literal)",
+        tokenize.OP: "(operator)",
+        tokenize.NAME: "(name)"
+        }
+    program = program.replace('&&', ' and ').replace('||', ' or ').replace('!', ' not ').replace('$', '').strip()
+    readline = StringIO(u"%s" % program).readline
+    for t in tokenize.generate_tokens(readline):
+        try:
+            yield type_map[t[0]], t[1]
+        except KeyError:
+            # Newer tokenize modules end the line even if there's no newline
+            if t[0] in (tokenize.NL, tokenize.NEWLINE):
+                continue
+            if t[0] == tokenize.ENDMARKER:
+                break
+            else:
+                raise SyntaxError("Syntax error")
+    yield "(end)", "(end)"
+
+def legacy_parse(program):
+    return twexpression.Parser(list(legacy_tokens(program))).expression()
+
+def lexer_parse(program):
+    # Bypasses the cache, so that every call goes through the lexer
+    return twexpression.Parser(program).expression()
+
+def parse_all(parse):
+    for expr in EXPRESSIONS:
+        parse(expr)
+
+def main():
+    for expr in EXPRESSIONS:
+        if repr(legacy_parse(expr)) != repr(lexer_parse(expr)):
+            print('Parse trees differ for {0!r}!'.format(expr))
+            sys.exit(1)
+
+    print('{0:>10} {1:>14} {2:>8}'.format('path', 'expr/s', 'speedup'))
+
+    number = 2000
+    timings = [
+        ('legacy', parse_all, legacy_parse),
+        ('lexer', parse_all, lexer_parse),
+        ('cached', parse_all, twexpression.parse)
+    ]
+    legacy_rate = None
+    for name, run, parse in timings:
+        elapsed = min(timeit.repeat(lambda: run(parse), number=number, repeat=3))
+        rate = number * len(EXPRESSIONS) / elapsed
+        legacy_rate = legacy_rate or rate
+        print('{0:>10} {1:>14,.0f} {2:>7.2f}x'.format(name, rate, rate / legacy_rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Checks the constant folding of expressions, and measures what it saves
+
+Generates random expressions and compiles each one with and without the
+folding; both versions are run by a small SAM evaluator, with 16 bit
+numbers, for several values of the variables, and must always give the
+same result. Then it reports how much shorter the folded code is.
+
+    python bench_folding.py
+    python bench_folding.py --count 100000 --seed 7
+"""
+
+from __future__ import print_function
+import argparse, os, random, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import twexpression
+
+VARIABLES = ['a', 'b', 'c']
+
+# The variables get every combination of these
+SAMPLE_VALUES = [0, 1, 2, 7, -1, -300, 32767, -32768]
+
+UNARY = ['-', '+', 'not ', '!']
+BINARY = ['+', '-', '*', '/', '%', 'and', 'or', '&&', '||', '==', '!=', '<>', 'is', 'eq',
+          '<', '<=', '>', '>=', 'lt', 'lte', 'gt', 'gte']
+
+def wrap(value):
+    """Wraps around to a signed 16 bit number"""
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+def run_sam(code, variables, rnd):
+    """Evaluates the code of an expression the way SAM would, and returns the value it leaves on the stack"""
+    stack = []
+    i = 0
+    while i < len(code):
+        ch = code[i]
+        if ch.isdigit():
+            start = i
+            while i < len(code) and code[i].isdigit():
+                i += 1
+            stack.append(wrap(int(code[start:i])))
+            continue
+        if ch.isupper():
+            if code[i + 1] != ':':
+                raise ValueError('unexpected {0!r} in {1!r}'.format(code[i:i + 2], code))
+            stack.append(variables[ch])
+            i += 2
+            continue
+        i += 1
+        if ch == ' ':
+            continue
+        if ch == 'r':
+            stack.append(rnd.randint(0, 32767))
+            continue
+        b = stack.pop()
+        a = stack.pop()
+        if ch == '+':
+            stack.append(wrap(a + b))
+        elif ch == '-':
+            stack.append(wrap(a - b))
+        elif ch == '*':
+            stack.append(wrap(a * b))
+        elif ch in '/\\':
+            if not b:
+                raise ZeroDivisionError
+            # Truncates toward zero, as C does
+            quotient = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            stack.append(wrap(quotient if ch == '/' else a - quotient * b))
+        elif ch == '=':
+            stack.append(int(a == b))
+        elif ch == '<':
+            stack.append(int(a < b))
+        elif ch == '>':
+            stack.append(int(a > b))
+        else:
+            raise ValueError('unknown operator {0!r} in {1!r}'.format(ch, code))
+    if len(stack) != 1:
+        raise ValueError('{0!r} leaves {1} values on the stack'.format(code, len(stack)))
+    return stack[0]
+
+def random_expression(rnd, depth):
+    """Returns the source of a random Twine expression, leaning towards constants so there's something to fold"""
+    if depth <= 0 or rnd.random() < 0.25:
+        kind = rnd.random()
+        if kind < 0.45:
+            return str(rnd.choice([0, 0, 1, 1, 2, 3, 10, 255, 256, 1000, 32767, rnd.randint(0, 99)]))
+        if kind < 0.5:
+            # Beyond what SAM's 16 bit numbers hold; SAM wraps them around
+            return str(rnd.choice([32768, 40000, 65535, 65536, 70000]))
+        if kind < 0.55:
+            return rnd.choice(['true', 'false'])
+        if kind < 0.9:
+            return '$' + rnd.choice(VARIABLES)
+        return 'random({0})'.format(rnd.randint(1, 9)) if rnd.random() < 0.5 else 'random(1, 6)'
+    if rnd.random() < 0.2:
+        return rnd.choice(UNARY) + '(' + random_expression(rnd, depth - 1) + ')'
+    return '(' + random_expression(rnd, depth - 1) + ' ' + rnd.choice(BINARY) + ' ' + random_expression(rnd, depth - 1) + ')'
+
+def evaluate(code, values, seed):
+    try:
+        return run_sam(code, values, random.Random(seed))
+    except ZeroDivisionError:
+        return 'division by zero'
+
+def check(program, registers):
+    """Compiles the expression both ways and compares the results; returns the lengths of both codes"""
+    plain = twexpression.to_sam(program, registers.get, optimize=False)
+    folded = twexpression.to_sam(program, registers.get)
+
+    for values in sample_variables():
+        expected = evaluate(plain, values, len(program))
+        result = evaluate(folded, values, len(program))
+        if result != expected:
+            raise AssertionError('{0}: {1!r} gives {2} but {3!r} gives {4} for {5}'.format(
+                program, plain, expected, folded, result, values))
+
+    return len(plain), len(folded)
+
+def sample_variables():
+    registers = [chr(ord('C') + i) for i in range(len(VARIABLES))]
+    for a in SAMPLE_VALUES:
+        for b in SAMPLE_VALUES[::3]:
+            for c in SAMPLE_VALUES[::2]:
+                yield dict(zip(registers, [a, b, c]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the constant folding of expressions against an evaluator")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    opts = parser.parse_args()
+
+    registers = dict((name, chr(ord('C') + i)) for i, name in enumerate(VARIABLES))
+    rnd = random.Random(opts.seed)
+
+    plain_total = folded_total = changed = 0
+    for i in range(opts.count):
+        plain, folded = check(random_expression(rnd, opts.depth), registers)
+        plain_total += plain
+        folded_total += folded
+        changed += plain != folded
+
+    print('{0} expressions checked, {1} of them shorter when folded'.format(opts.count, changed))
+    print('{0} bytes of code without folding, {1} with it ({2:.1%} saved)'.format(
+        plain_total, folded_total, 1 - folded_total / float(plain_total or 1)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for Passage._parse_commands
+
+Times the command parser on machine-generated passages with many macros
+and with deeply nested <<if>> blocks, next to the old recursive parser
+that consumed its tokens with list.pop(0).
+"""
+
+from __future__ import print_function
+import sys, os, timeit
+import logging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from twparser import Passage, TiddlerRecord, TextCmd, ImageCmd, LinkCmd, ListCmd, IfMacro, EndMacro
+
+class LegacyPassage(Passage):
+    """Passage using the old recursive parser"""
+
+    def _parse(self, tiddler):
+        self._block_stack = []
+        self.commands += self._parse_commands(list(self._tokenize(tiddler)))
+
+    def _parse_commands(self, tokens):
+        commands = []
+        close_block = False
+
+        while tokens and not close_block:
+            token = tokens.pop(0)
+            tk_type = token[0]
+            if tk_type == 'tx':
+                commands.append(TextCmd(token))
+            elif tk_type == 'mc':
+                macro = self._parse_macro(token)
+                if isinstance(macro, IfMacro):
+                    macro.children = self._parse_commands(tokens)
+                    macro = self._check_macro(token, macro)
+                if isinstance(macro, EndMacro):
+                    close_block = True
+                elif macro:
+                    commands.append(macro)
+            elif tk_type == 'im':
+                commands.append(ImageCmd(token))
+            elif tk_type == 'lk':
+                commands.append(LinkCmd(token))
+            elif tk_type in ('ul','ol'):
+                commands.append(ListCmd(token, self._parse_commands(list(token[1]))))
+
+        return commands
+
+def flat_passage(count):
+    return u''.join(u'Line {0} <<set $x = {0}>> [[Next|P{0}]]\n'.format(i) for i in range(count))
+
+def nested_passage(depth):
+    return u'<<if $x gt 1>>text ' * depth + u'<<endif>>' * depth
+
+def time_parse(cls, text):
+    record = TiddlerRecord('Benchmark', text)
+    try:
+        return min(timeit.repeat(lambda: cls(record), number=1, repeat=3))
+    except RuntimeError:
+        # The old parser recurses once per nesting level
+        return None
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print('{0:<16} {1:>8} {2:>12} {3:>12}'.format('passage', 'size', 'legacy (ms)', 'cursor (ms)'))
+
+    cases = [('flat macros', n, flat_passage(n)) for n in (1000, 4000, 16000)]
+    cases += [('nested <<if>>', n, nested_passage(n)) for n in (100, 1000, 5000)]
+    for name, size, text in cases:
+        legacy = time_parse(LegacyPassage, text)
+        cursor = time_parse(Passage, text)
+        print('{0:<16} {1:>8} {2:>12} {3:>12.1f}'.format(
+            name, size, '{0:.1f}'.format(legacy * 1000) if legacy is not None else 'overflow', cursor * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for Passage._tokenize_string
+
+Compares the single-pass scanner with the old recursive regex cascade on
+passages of growing size, checking that both produce the same tokens.
+"""
+
+from __future__ import print_function
+import sys, os, timeit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from twparser import Passage
+
+SNIPPET = u'''You are in a maze of twisty little passages, all alike. <<set $steps = $steps + 1>>
+<<if $steps gt 10>>You feel tired. <<print $steps>><<endif>>
+[img[maze.png]] There is a [[lamp|Lamp]] here, and a [[door]].
+* [[Go north|North]]
+# [[Go south|South]]
+'''
+
+def legacy_tokenize(passage, string):
+    """The recursive cascade that used to be Passage._tokenize_string"""
+    def test_command(string, remaining_tests):
+        if not remaining_tests:
+            return []
+
+        regex, action, skipped_chars = remaining_tests[0]
+        remaining_tests = remaining_tests[1:]
+
+        tokens = []
+        st_pos = 0
+        st_len = len(string)
+        for item in regex.finditer(string):
+            it_st = item.start()
+            if st_pos < it_st and st_pos < st_len:
+                tokens += test_command(string[st_pos:it_st], remaining_tests)
+            st_pos = item.end() + skipped_chars
+            tokens += action(item)
+
+        if st_pos < st_len:
+            tokens += test_command(string[st_pos:st_len], remaining_tests)
+
+        return tokens
+
+    def process_item_list(match):
+        list_type = 'ul' if match.group(1) == '*' else 'ol'
+        return [(list_type, legacy_tokenize(passage, match.group(2).strip()))]
+
+    tests = [
+        (Passage.RE_ITEM_LIST, process_item_list, 1),
+        (Passage.RE_MACRO, lambda match: [('mc', (match.group(1), match.group(2)))], 0),
+        (Passage.RE_IMG, lambda match: [('im', match.group(1))], 0),
+        (Passage.RE_LINK, lambda match: [('lk', match.group(1))], 0),
+        (Passage.RE_TEXT, lambda match: [('tx', match.group(1))], 0)
+    ]
+
+    return test_command(string, tests)
+
+def strip_offsets(tokens):
+    """Drops the offsets, leaving the tokens in the legacy (kind, value) form"""
+    return [(tk[0], strip_offsets(tk[1]) if tk[0] in ('ul', 'ol') else tk[1]) for tk in tokens]
+
+def main():
+    passage = Passage.__new__(Passage)
+    print('{0:>10} {1:>8} {2:>12} {3:>12} {4:>8}'.format('chars', 'tokens', 'legacy (ms)', 'single (ms)', 'speedup'))
+
+    for repeat in (10, 100, 1000, 10000):
+        source = SNIPPET * repeat
+
+        new_tokens = list(passage._tokenize_string(source))
+        if strip_offsets(new_tokens) != legacy_tokenize(passage, source):
+            print('Token streams differ for {0} repetitions!'.format(repeat))
+            sys.exit(1)
+
+        number = max(1, 1000 // repeat)
+        legacy = min(timeit.repeat(lambda: legacy_tokenize(passage, source), number=number, repeat=3)) / number
+        single = min(timeit.repeat(lambda: list(passage._tokenize_string(source)), number=number, repeat=3)) / number
+
+        print('{0:>10} {1:>8} {2:>12.3f} {3:>12.3f} {4:>7.2f}x'.format(
+            len(source), len(new_tokens), legacy * 1000, single * 1000, legacy / single))
+
+if __name__ == '__main__':
+    main()
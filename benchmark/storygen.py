@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Generates synthetic twee stories for benchmarking
+
+Every aspect that affects the compile time can be scaled on its own: the
+number of passages, the links per passage, the macros per passage, how deep
+the <<if>> blocks nest, how many passages <<display>> shared snippets and
+how long each passage's text is.
+"""
+
+from __future__ import print_function
+import argparse, io, random
+
+WORDS = u'''the a cave dark lamp door north south east west you see hear feel
+cold wet narrow passage room hall stairs bird cage rod gold silver treasure
+grate water stream forest road building valley pit crack chamber wall'''.split()
+
+VARIABLES = [u'gold', u'lamp', u'steps', u'keys', u'bird', u'water', u'score', u'visited']
+
+class StoryOptions(object):
+    """The knobs for the generated story"""
+
+    def __init__(self, passages=1000, links=3, macros=4, nesting=2, shared=10, display_ratio=0.3, words=40, seed=1):
+        self.passages = passages
+        self.links = links
+        self.macros = macros
+        self.nesting = nesting
+        self.shared = shared
+        self.display_ratio = display_ratio
+        self.words = words
+        self.seed = seed
+
+def generate_story(options):
+    """Returns the twee source of a synthetic story"""
+    rnd = random.Random(options.seed)
+    out = []
+
+    def text(count):
+        return u' '.join(rnd.choice(WORDS) for i in range(count)).capitalize() + u'. '
+
+    def expression():
+        var = rnd.choice(VARIABLES)
+        return rnd.choice([
+            u'${0}'.format(var),
+            u'!${0}'.format(var),
+            u'${0} gt {1}'.format(var, rnd.randint(0, 9)),
+            u'${0} + {1} == ${2}'.format(var, rnd.randint(1, 5), rnd.choice(VARIABLES)),
+            u'${0} and not ${1}'.format(var, rnd.choice(VARIABLES))
+        ])
+
+    def macro(depth):
+        kind = rnd.choice(['set', 'set', 'print', 'if'])
+        if kind == 'set':
+            return u'<<set ${0} = {1}>>'.format(rnd.choice(VARIABLES), expression() if rnd.random() < 0.5 else rnd.randint(0, 99))
+        if kind == 'print':
+            return u'<<print ${0}>>'.format(rnd.choice(VARIABLES))
+        inner = macro(depth + 1) if depth < options.nesting else text(3)
+        return u'<<if {0}>>{1}{2}<<endif>>'.format(expression(), text(4), inner)
+
+    def link():
+        target = u'P{0}'.format(rnd.randrange(options.passages))
+        if rnd.random() < 0.5:
+            return u'[[{0}]]'.format(target)
+        return u'[[Go to {0}|{0}]]'.format(target)
+
+    for i in range(options.shared):
+        out.append(u':: Shared{0}\n{1}<<print $score>>\n\n'.format(i, text(8)))
+
+    for i in range(options.passages):
+        title = u'Start' if i == 0 else u'P{0}'.format(i)
+        parts = [text(max(1, options.words // 2))]
+        if options.shared and rnd.random() < options.display_ratio:
+            parts.append(u'<<display "Shared{0}">>'.format(rnd.randrange(options.shared)))
+        for m in range(options.macros):
+            parts.append(macro(1))
+        parts.append(text(max(1, options.words - options.words // 2)))
+        parts.append(u'\n')
+        parts.extend(link() + u'\n' for l in range(options.links))
+        out.append(u':: {0}\n{1}\n'.format(title, u''.join(parts)))
+
+    # Passage 0 is Start, so links to P0 need a passage as well
+    out.append(u':: P0\n{0}[[Start]]\n\n'.format(text(5)))
+
+    return u''.join(out)
+
+def add_story_arguments(parser):
+    parser.add_argument("-n", "--passages", type=int, default=1000)
+    parser.add_argument("--links", type=int, default=3)
+    parser.add_argument("--macros", type=int, default=4)
+    parser.add_argument("--nesting", type=int, default=2)
+    parser.add_argument("--shared", type=int, default=10)
+    parser.add_argument("--display-ratio", type=float, default=0.3)
+    parser.add_argument("--words", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1)
+
+def story_options(opts, **overrides):
+    options = StoryOptions(opts.passages, opts.links, opts.macros, opts.nesting, opts.shared, opts.display_ratio, opts.words, opts.seed)
+    for name, value in overrides.items():
+        setattr(options, name, value)
+    return options
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic twee story")
+    add_story_arguments(parser)
+    parser.add_argument("output")
+    opts = parser.parse_args()
+
+    with io.open(opts.output, 'w', encoding="utf-8") as f:
+        f.write(generate_story(story_options(opts)))
+
+if __name__ == '__main__':
+    main()
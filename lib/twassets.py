@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os, shutil, hashlib
+import errno
+import logging
+from multiprocessing.pool import ThreadPool
+
+__version__ = "0.1"
+
+log = logging.getLogger('twee2sam')
+
+# Copying is mostly waiting on the disk, so a few threads help even on a single core
+DEFAULT_THREADS = 4
+
+class AssetList(object):
+    """Keeps the assets in the order they were first referenced, along with their indexes"""
+
+    def __init__(self, paths=()):
+        self.paths = []
+        self.indexes = {}
+        self.extend(paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.indexes
+
+    def add(self, path):
+        """Returns the index of the asset, adding it to the end of the list if it's not there yet"""
+        index = self.indexes.get(path)
+        if index is None:
+            index = self.indexes[path] = len(self.paths)
+            self.paths.append(path)
+        return index
+
+    def get(self, path):
+        """Returns the index of the asset, or None if it's not on the list"""
+        return self.indexes.get(path)
+
+    def extend(self, paths):
+        for path in paths:
+            self.add(path)
+
+class AssetCopier(object):
+    """Copies the assets into the destination, skipping the ones that are already up to date
+
+    'check' can be 'mtime' (same size and modification time) or 'hash' (same contents);
+    with 'link' set, the assets are hardlinked instead of copied, wherever possible.
+    """
+
+    def __init__(self, check='mtime', link=False, threads=DEFAULT_THREADS):
+        self.check = check
+        self.link = link
+        self.threads = threads
+        self.copied = 0
+        self.skipped = 0
+
+    def copy_all(self, copies):
+        """Copies a list of (source, destination) pairs"""
+        # If two assets end up with the same name, the last one wins, as it would if they were copied in order
+        latest = {}
+        for source, destination in copies:
+            latest[destination] = source
+        jobs = [(source, destination) for destination, source in latest.items()]
+
+        if self.threads > 1 and len(jobs) > 1:
+            pool = ThreadPool(min(self.threads, len(jobs)))
+            try:
+                results = pool.map(self._copy_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._copy_job(job) for job in jobs]
+
+        copied = sum(results)
+        self.copied += copied
+        self.skipped += len(results) - copied
+
+    def _copy_job(self, job):
+        return self.copy(*job)
+
+    def copy(self, source, destination):
+        """Copies (or links) a single asset; returns False if it was already up to date"""
+        if self.is_current(source, destination):
+            return False
+
+        if os.path.lexists(destination):
+            os.remove(destination)
+
+        if self.link:
+            try:
+                os.link(source, destination)
+                return True
+            except (AttributeError, OSError) as e:
+                # No hardlinks on this platform or across these filesystems
+                log.debug('twassets: can\'t link "{0}" ({1}); copying it instead'.format(source, e))
+
+        # copy2 keeps the modification time, which the 'mtime' check relies on
+        shutil.copy2(source, destination)
+        return True
+
+    def is_current(self, source, destination):
+        try:
+            dst_stat = os.stat(destination)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        src_stat = os.stat(source)
+        if self.link and hasattr(os.path, 'samestat') and os.path.samestat(src_stat, dst_stat):
+            return True
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        if self.check == 'hash':
+            return file_digest(source) == file_digest(destination)
+        return int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+def file_digest(path, block_size=65536):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
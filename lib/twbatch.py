@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import io, json, os, shlex
+
+__version__ = "0.1"
+
+# A jobs file holds a JSON object like this one:
+#
+#   {
+#    "defaults": ["--pack"],
+#    "jobs": [
+#     {"name": "ccadv", "sources": "ccadv/tw/ccadv.txt", "destination": "out/ccadv"},
+#     {"sources": "demo/*.tw", "destination": "out/demo", "options": ["-d", "subroutine"]}
+#    ]
+#   }
+#
+# Each job gets the options twee2sam would get on the command line: the defaults, followed by its own options,
+# either as a list or as a single string. The name, shown on the reports, defaults to the destination.
+# Relative paths are taken from the directory the jobs file is in.
+
+# JSON strings are unicode on Python 2
+STRING_TYPES = (type(u''), str)
+
+class BatchError(Exception):
+    """Raised for jobs files that can't be used"""
+
+class Job(object):
+    """A story to compile, along with the command line it's compiled with"""
+
+    def __init__(self, name, args, base):
+        self.name = name
+        self.args = args
+        self.base = base
+
+    def path(self, path):
+        """Returns a path from the job, taken from the directory of the jobs file"""
+        return os.path.join(self.base, path) if path else path
+
+def read_jobs(path):
+    """Returns the jobs in a jobs file"""
+    try:
+        with io.open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except ValueError as e:
+        raise BatchError('"{0}" is not valid JSON: {1}'.format(path, e))
+
+    if not isinstance(data, dict) or not isinstance(data.get('jobs'), list):
+        raise BatchError('"{0}" has no list of "jobs"'.format(path))
+
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = _options(data.get('defaults', []), 'the defaults')
+
+    jobs = []
+    names = set()
+    for i, entry in enumerate(data['jobs']):
+        if not isinstance(entry, dict) or not entry.get('sources') or not entry.get('destination'):
+            raise BatchError('job #{0} of "{1}" needs both the "sources" and the "destination"'.format(i + 1, path))
+
+        name = u'{0}'.format(entry.get('name') or entry['destination'])
+        if name in names:
+            raise BatchError('"{0}" has more than one job named "{1}"'.format(path, name))
+        names.add(name)
+
+        args = defaults + _options(entry.get('options', []), 'job "{0}"'.format(name)) + [entry['sources'], entry['destination']]
+        jobs.append(Job(name, args, base))
+
+    return jobs
+
+def _options(options, what):
+    if isinstance(options, list) and all(isinstance(option, STRING_TYPES) for option in options):
+        return list(options)
+    if isinstance(options, STRING_TYPES):
+        return shlex.split(options)
+    raise BatchError('the options of {0} must be a list of strings, or a single string'.format(what))
@@ -5,13 +5,15 @@
 
 import sys
 import re
+import threading
+from collections import namedtuple, OrderedDict
 
-import tokenize
-from io import StringIO
+__version__ = "0.2"
 
-#TODO: remove global usage
-token = None
-_next = None
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 # symbol (token type) registry
 
@@ -19,14 +21,19 @@ symbol_table = {}
 
 class symbol_base(object):
 
+    # Expressions are tiny, but there are a lot of them
+    __slots__ = ('value', 'first', 'second', 'third')
+
     id = None
-    value = None
-    first = second = third = None
 
-    def nud(self):
+    def __init__(self, value=None):
+        self.value = value
+        self.first = self.second = self.third = None
+
+    def nud(self, parser):
         raise SyntaxError("Syntax error (%r)." % self.id)
 
-    def led(self, left):
+    def led(self, parser, left):
         raise SyntaxError("Unknown operator (%r)." % self.id)
 
     def __repr__(self):
@@ -36,15 +43,23 @@ class symbol_base(object):
         out = map(str, filter(None, out))
         return "(%s)" % " ".join(out)
 
+    def __reduce__(self):
+        # The symbol classes are created on the fly, so they're pickled by their id
+        return (_rebuild_symbol, (self.id, self.value, self.first, self.second, self.third))
+
+def _rebuild_symbol(id, value, first, second, third):
+    s = symbol_table[id](value)
+    s.first, s.second, s.third = first, second, third
+    return s
+
 def symbol(id, bp=0):
     try:
         s = symbol_table[id]
     except KeyError:
         class s(symbol_base):
-            pass
+            __slots__ = ()
         s.__name__ = "symbol-" + id # for debugging
         s.id = id
-        s.value = None
         s.lbp = bp
         symbol_table[id] = s
     else:
@@ -54,31 +69,25 @@ def symbol(id, bp=0):
 # helpers
 
 def infix(id, bp):
-    def led(self, left):
+    def led(self, parser, left):
         self.first = left
-        self.second = expression(bp)
+        self.second = parser.expression(bp)
         return self
     symbol(id, bp).led = led
 
 def infix_r(id, bp):
-    def led(self, left):
+    def led(self, parser, left):
         self.first = left
-        self.second = expression(bp-1)
+        self.second = parser.expression(bp-1)
         return self
     symbol(id, bp).led = led
 
 def prefix(id, bp):
-    def nud(self):
-        self.first = expression(bp)
+    def nud(self, parser):
+        self.first = parser.expression(bp)
         return self
     symbol(id).nud = nud
 
-def advance(id=None):
-    global token
-    if id and token.id != id:
-        raise SyntaxError("Expected %r" % id)
-    token = _next()
-
 def method(s):
     # decorator
     assert issubclass(s, symbol_base)
@@ -105,33 +114,33 @@ symbol("(", 150)
 
 # additional behaviour
 
-symbol("(name)").nud = lambda self: self
-symbol("(literal)").nud = lambda self: self
+symbol("(name)").nud = lambda self, parser: self
+symbol("(literal)").nud = lambda self, parser: self
 
 symbol("(end)")
 
 symbol(")")
 
 @method(symbol("("))
-def nud(self):
+def nud(self, parser):
     # parenthesized form; replaced by tuple former below
-    expr = expression()
-    advance(")")
+    expr = parser.expression()
+    parser.advance(")")
     return expr
 
 symbol(")"); symbol(",")
 
 @method(symbol("("))
-def led(self, left):
+def led(self, parser, left):
     self.first = left
     self.second = []
-    if token.id != ")":
+    if parser.token.id != ")":
         while 1:
-            self.second.append(expression())
-            if token.id != ",":
+            self.second.append(parser.expression())
+            if parser.token.id != ",":
                 break
-            advance(",")
-    advance(")")
+            parser.advance(",")
+    parser.advance(")")
     return self
 
 symbol(":"); symbol("=")
@@ -140,86 +149,183 @@ symbol(":"); symbol("=")
 
 def constant(id):
     @method(symbol(id))
-    def nud(self):
-        self.id = "(literal)"
-        self.value = id
-        return self
+    def nud(self, parser):
+        return symbol_table["(literal)"](id)
 
 constant("true")
 constant("false")
 
-# python tokenizer
+# expression lexer
+
+# Twine spells some of the operators differently
+OPERATOR_ALIASES = {
+    '&&': 'and',
+    '||': 'or',
+    '!': 'not',
+    'eq': '==',
+    'neq': '!=',
+    'gt': '>',
+    'gte': '>=',
+    'lt': '<',
+    'lte': '<='
+}
 
-def tokenize_python(program):
-    type_map = {
-        tokenize.NUMBER: "(literal)",
-        tokenize.STRING: "(literal)",
-        tokenize.OP: "(operator)",
-        tokenize.NAME: "(name)"
-        }
-    try:
-        tok = tokenize.generate_tokens(StringIO(u"%s" % program).__next__)
-    except AttributeError:
-        tok = tokenize.generate_tokens(StringIO(u"%s" % program).next)
-    for t in tok:
-        try:
-            yield type_map[t[0]], t[1]
-        except KeyError:
-            if t[0] == tokenize.NL:
-                continue
-            if t[0] == tokenize.ENDMARKER:
-                break
+RE_TOKEN = re.compile(r"""\s*(?:
+    (0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)  # number
+    |("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')                    # string
+    |(\$)?([^\W\d]\w*)                                        # variable or word operator
+    |(&&|\|\||<>|[<>!=]=|[-+*/%<>()=,:!])                      # operator
+    |(\S)                                                     # anything else
+    )""", re.VERBOSE | re.UNICODE)
+
+def tokenize_expression(program):
+    """Splits a Twine expression into symbols, ending with an (end) symbol"""
+    literal = symbol_table["(literal)"]
+    name = symbol_table["(name)"]
+    for match in RE_TOKEN.finditer(program):
+        number, string, sigil, word, operator, unknown = match.groups()
+        if word:
+            if sigil:
+                yield name(word)
             else:
-                raise SyntaxError("Syntax error")
-    yield "(end)", "(end)"
+                word = OPERATOR_ALIASES.get(word, word)
+                s = symbol_table.get(word)
+                yield s() if s else name(word)
+        elif operator:
+            yield symbol_table[OPERATOR_ALIASES.get(operator, operator)]()
+        elif number or string:
+            yield literal(number or string)
+        else:
+            raise SyntaxError("Unknown operator (%r)" % unknown)
+    yield symbol_table["(end)"]()
 
 def tokenizing(program):
-    if isinstance(program, list):
-        source = program
-    else:
-        # Hack to make JS boolean operators work with the Python tokenizer
-        program = program.replace('&&', ' and ').replace('||', ' or ').replace('!', ' not ').replace('$', '').strip()
-        source = tokenize_python(program)
+    if not isinstance(program, list):
+        return tokenize_expression(program)
+    return _symbols_from_tokens(program)
+
+def _symbols_from_tokens(source):
+    """Turns a list of (id, value) tokens into symbols"""
     for id, value in source:
         if id == "(literal)":
-            symbol = symbol_table[id]
-            s = symbol()
-            s.value = value
+            s = symbol_table[id](value)
         else:
             # name or operator
             symbol = symbol_table.get(value)
             if symbol:
                 s = symbol()
             elif id == "(name)":
-                symbol = symbol_table[id]
-                s = symbol()
-                s.value = value
+                s = symbol_table[id](value)
             else:
                 raise SyntaxError("Unknown operator (%r)" % id)
         yield s
 
 # parser engine
 
-def expression(rbp=0):
-    global token
-    t = token
-    token = _next()
-    left = t.nud()
-    while rbp < token.lbp:
-        t = token
-        token = _next()
-        left = t.led(left)
-    return left
+class Parser(object):
+    """Parses a single expression; all of the parsing state is kept in the instance"""
+
+    def __init__(self, program):
+        tokens = tokenizing(program)
+        try:
+            self._next = tokens.__next__
+        except AttributeError:
+            self._next = tokens.next
+        self.token = self._next()
+
+    def advance(self, id=None):
+        if id and self.token.id != id:
+            raise SyntaxError("Expected %r" % id)
+        self.token = self._next()
+
+    def expression(self, rbp=0):
+        t = self.token
+        self.token = self._next()
+        left = t.nud(self)
+        while rbp < self.token.lbp:
+            t = self.token
+            self.token = self._next()
+            left = t.led(self, left)
+        return left
+
+# caching
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache that keeps hit/miss statistics"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def items(self):
+        """Returns the (key, value) pairs, least recently used first"""
+        with self._lock:
+            return list(self._entries.items())
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+# Parsed trees are shared between everyone parsing the same source, so they must not be modified
+_parse_cache = LRUCache(4096)
+
+# Keyed by the tree's id; each entry keeps a reference to the tree, so that the id can't be reused
+_sam_cache = LRUCache(4096)
+
+def cache_info():
+    """Returns the statistics for the parsed expression and generated SAM caches"""
+    return {'parse': _parse_cache.info(), 'to_sam': _sam_cache.info()}
+
+def clear_caches():
+    _parse_cache.clear()
+    _sam_cache.clear()
+
+def parsed_expressions():
+    """Returns the (source, tree) pairs in the parse cache, so they can be kept for another run"""
+    return _parse_cache.items()
+
+def preload_parsed_expressions(items):
+    """Puts trees kept from another run back in the parse cache"""
+    for source, parsed in items:
+        _parse_cache.put(source, parsed)
 
 def parse(program):
-    global _next, token
-    #import pdb; pdb.set_trace()
-    try:
-        _next = tokenizing(program).__next__
-    except AttributeError:
-        _next = tokenizing(program).next
-    token = _next()
-    return expression()
+    if isinstance(program, list):
+        return Parser(program).expression()
+
+    source = program.strip()
+    parsed = _parse_cache.get(source)
+    if parsed is None:
+        parsed = Parser(source).expression()
+        _parse_cache.put(source, parsed)
+    return parsed
 
 def test(program):
     print(">>>", program)
@@ -248,48 +354,258 @@ OPERATOR_TABLE = {
     '%': '\\'
 }
 
-def to_sam(program, var_locator = lambda s: s + '?'):
-    parsed = parse(program) if isinstance(program, str) else program
+# Constant folding
+#
+# SAM numbers are 16 bit. Additions, subtractions and products are folded as
+# long as every value stays within the signed range, where wrapping around
+# can't make a difference; comparisons, divisions and remainders are only
+# folded for values that aren't negative, so it doesn't matter either whether
+# SAM treats them as signed. Anything else is left for SAM to compute.
+
+INT_MIN = -32768
+INT_MAX = 32767
+
+# Operators whose result is always 0 or 1
+BOOLEAN_OPERATORS = frozenset(['not', 'and', 'or', 'is', '==', '<>', '!=', '<', '<=', '>', '>='])
+
+def fold(parsed):
+    """Returns the expression with its constant parts computed and the operations that don't change anything dropped
+
+    The parsed expression is shared through the caches, so it's never changed; the parts that do change are copied.
+    """
+    if parsed.id in ('(literal)', '(name)'):
+        return parsed
+    if parsed.id == '(':
+        # Function calls stay, but their parameters can still be folded
+        return _node('(', parsed.first, [fold(param) for param in parsed.second])
+    if parsed.second is None:
+        return _fold_unary(parsed.id, fold(parsed.first))
+    return _fold_binary(parsed.id, fold(parsed.first), fold(parsed.second))
+
+def _node(id, first, second=None):
+    s = symbol_table[id]()
+    s.first, s.second = first, second
+    return s
+
+def _constant(value):
+    """Returns the expression for an integer; SAM has no negative literals, so those are negations"""
+    if value < 0:
+        return _node('-', symbol_table['(literal)'](str(-value)))
+    return symbol_table['(literal)'](str(value))
+
+def _constant_value(parsed):
+    """Returns the integer value of the expression, or None if it isn't a constant integer
+
+    Literals SAM can't hold are left alone too, since SAM wraps them around.
+    """
+    if parsed.id == '(literal)':
+        value = CONST_TABLE.get(parsed.value, parsed.value)
+        return int(value) if value.isdigit() and int(value) <= INT_MAX else None
+    if parsed.id == '-' and parsed.second is None:
+        value = _constant_value(parsed.first)
+        return -value if value is not None else None
+    return None
+
+def _is_boolean(parsed):
+    return parsed.id in BOOLEAN_OPERATORS or _constant_value(parsed) in (0, 1)
+
+def _is_pure(parsed):
+    """Tells whether dropping the expression wouldn't change anything
+
+    random() moves the random number generator along, and dividing by zero stops the script.
+    """
+    if parsed.id == '(':
+        return False
+    if parsed.id in ('/', '%') and not _constant_value(parsed.second):
+        return False
+    return all(_is_pure(child) for child in (parsed.first, parsed.second) if isinstance(child, symbol_base))
+
+def _in_range(value):
+    return value is not None and INT_MIN <= value <= INT_MAX
+
+def _positive(parsed):
+    """Returns an expression that's 1 when the given one is above zero, and 0 otherwise"""
+    return parsed if _is_boolean(parsed) else _node('>', parsed, _constant(0))
+
+def _compute(id, a, b):
+    """Returns what SAM would compute for the binary operator on two constants, or None if it can't be told"""
+    if id in ('+', '-', '*'):
+        result = a + b if id == '+' else a - b if id == '-' else a * b
+        return result if _in_range(result) else None
+    if id in ('is', '=='):
+        return int(a == b)
+    if id in ('<>', '!='):
+        return int(a != b)
+    if a < 0 or b < 0:
+        return None
+    if id in ('/', '%'):
+        if not b:
+            return None
+        return a // b if id == '/' else a % b
+    if id in ('and', 'or'):
+        # SAM's 'and' is a product above zero, and its 'or' is a sum above zero
+        result = a * b if id == 'and' else a + b
+        return int(result > 0) if _in_range(result) else None
+    if id == '<':
+        return int(a < b)
+    if id == '<=':
+        return int(a <= b)
+    if id == '>':
+        return int(a > b)
+    if id == '>=':
+        return int(a >= b)
+    return None
+
+def _fold_unary(id, operand):
+    value = _constant_value(operand)
+    if id == '+':
+        return operand
+    if id == '-':
+        if value is not None and _in_range(-value):
+            return _constant(-value)
+        if operand.id == '-' and operand.second is None:
+            return operand.first
+    elif id == 'not' and value is not None:
+        return _constant(int(value == 0))
+    return _node(id, operand)
+
+def _fold_binary(id, first, second):
+    a = _constant_value(first)
+    b = _constant_value(second)
+
+    if a is not None and b is not None:
+        result = _compute(id, a, b)
+        if result is not None:
+            return _constant(result)
+
+    if id == '+':
+        if a == 0:
+            return second
+        if b == 0:
+            return first
+    elif id == '-':
+        if b == 0:
+            return first
+    elif id == '*':
+        if a == 1:
+            return second
+        if b == 1:
+            return first
+        if (a == 0 and _is_pure(second)) or (b == 0 and _is_pure(first)):
+            return _constant(0)
+    elif id == '/':
+        if b == 1:
+            return first
+    elif id in ('and', 'or'):
+        constant, other = (a, second) if a is not None else (b, first)
+        if id == 'and':
+            # 1 * x > 0 is just x > 0, and 0 * x > 0 never holds
+            if constant == 1:
+                return _positive(other)
+            if constant == 0 and _is_pure(other):
+                return _constant(0)
+        else:
+            # 0 + x > 0 is just x > 0; with x being 0 or 1, c + x > 0 always holds
+            if constant == 0:
+                return _positive(other)
+            if constant is not None and 0 < constant < INT_MAX and _is_boolean(other) and _is_pure(other):
+                return _constant(1)
+    elif id == '<=':
+        # SAM has no <= (it's "not >"), but against a constant it can be a < instead
+        if b is not None and 0 <= b < INT_MAX:
+            return _node('<', first, _constant(b + 1))
+        if a is not None and a > 0:
+            return _node('<', _constant(a - 1), second)
+    elif id == '>=':
+        if b is not None and b > 0:
+            return _node('>', first, _constant(b - 1))
+        if a is not None and 0 <= a < INT_MAX:
+            return _node('>', _constant(a + 1), second)
+
+    return _node(id, first, second)
+
+def to_sam(program, var_locator = lambda s: s + '?', optimize=True):
+    template = _sam_template(program, optimize)
+
+    # Odd positions hold the variable names, in the order they're read
+    generated = [template[0]]
+    for i in range(1, len(template), 2):
+        var_name = var_locator(template[i])
+        generated.extend([var_name, ' :' if var_name.isdigit() else ':', template[i + 1]])
+
+    return ''.join(generated)
+
+def variable_names(program, optimize=True):
+    """Lists the variables read by the expression, in the order to_sam() reads them"""
+    return _sam_template(program, optimize)[1::2]
+
+def _sam_template(program, optimize=True):
+    """Returns the generated code as [code, variable, code, variable, ..., code]; it doesn't depend on where variables are"""
+    parsed = parse(program) if isinstance(program, string_types) else program
+
+    key = (id(parsed), optimize)
+    entry = _sam_cache.get(key)
+    if entry is not None and entry[0] is parsed:
+        return entry[1]
+
+    template = ['']
+
+    def emit(code):
+        # A number only needs the space after it when another number follows
+        if optimize and template[-1].endswith(' ') and code[:1] and not code[:1].isdigit():
+            template[-1] = template[-1][:-1]
+        template[-1] += code
 
     def process_node(parsed):
-        generated = []
         if parsed.id == '(literal)':
             # It's either a numeric literal or a constant
-            generated.extend([CONST_TABLE.get(parsed.value, parsed.value), ' '])
+            emit(CONST_TABLE.get(parsed.value, parsed.value) + ' ')
         elif parsed.id == '(name)':
             # It's reading a variable
-            var_name = var_locator(parsed.value)
-            generated.extend([var_name, ' :' if var_name.isdigit() else ':'])
+            template.extend([parsed.value, ''])
         elif parsed.id in ('+', '-'):
             # + and - can be either unary or binary.
             if parsed.second:
                 # It's binary
-                generated.extend([process_node(parsed.first), process_node(parsed.second), parsed.id])
+                process_node(parsed.first)
+                process_node(parsed.second)
+                emit(parsed.id)
             elif parsed.id == '-':
                 # It's a negation
-                generated.extend(['0 ', process_node(parsed.first), '-'])
+                emit('0 ')
+                process_node(parsed.first)
+                emit('-')
             else:
                 # It's a no-op
-                generated.extend([process_node(parsed.first)])
+                process_node(parsed.first)
         elif parsed.id == '(':
             # It's a function call
             function_name = parsed.first.value
             if function_name == 'random':
                 params = parsed.second
-                generated.extend(['r'])
+                emit('r')
                 if len(params) == 1:
-                    generated.extend([process_node(params[0]), '\\'])
+                    process_node(params[0])
+                    emit('\\')
                 elif len(params) == 2:
-                    generated.extend([process_node(params[1]), process_node(params[0]), '-1+\\', process_node(params[0]), '+'])
+                    process_node(params[1])
+                    process_node(params[0])
+                    emit('-1+\\')
+                    process_node(params[0])
+                    emit('+')
             else:
                 raise SyntaxError("Unknown function (%r)" % function_name)
         elif parsed.second:
             # Assumes it's a binary operator
-            generated.extend([process_node(parsed.first), process_node(parsed.second), OPERATOR_TABLE.get(parsed.id, parsed.id)])
+            process_node(parsed.first)
+            process_node(parsed.second)
+            emit(OPERATOR_TABLE.get(parsed.id, parsed.id))
         else:
             # Assumes it's an unary operator
-            generated.extend([process_node(parsed.first), OPERATOR_TABLE.get(parsed.id, parsed.id)])
+            process_node(parsed.first)
+            emit(OPERATOR_TABLE.get(parsed.id, parsed.id))
 
-        return ''.join(generated)
+    process_node(fold(parsed) if optimize else parsed)
 
-    return process_node(parsed)
\ No newline at end of file
+    _sam_cache.put(key, (parsed, template))
+    return template
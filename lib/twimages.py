@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import io, os, json, struct, zlib, hashlib
+import logging
+
+__version__ = "0.1"
+
+log = logging.getLogger('twee2sam')
+
+# What SAM can display
+IMAGE_WIDTH = 256
+IMAGE_HEIGHT = 144
+MAX_COLORS = 16
+MAX_TILES = 320
+TILE_SIZE = 8
+
+CACHE_NAME = 'twee2sam.images.json'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Samples per pixel for each PNG color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+class PngError(Exception):
+    """Raised for files that can't be decoded"""
+
+class PngImage(object):
+    """A decoded PNG; rows holds the unfiltered scanlines, so pixels are left in whatever format the file uses"""
+
+    def __init__(self, width, height, bit_depth, color_type, rows):
+        self.width = width
+        self.height = height
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.bits_per_pixel = bit_depth * PNG_CHANNELS[color_type]
+        self.rows = rows
+
+    def count_colors(self):
+        """Counts the distinct pixel values (palette indexes, for paletted images)"""
+        colors = set()
+        bits = self.bits_per_pixel
+        if bits < 8:
+            # Several pixels per byte, leftmost pixel on the most significant bits
+            per_byte = 8 // bits
+            mask = (1 << bits) - 1
+            unpacked = [[(value >> (8 - bits * (i + 1))) & mask for i in range(per_byte)] for value in range(256)]
+            for row in self.rows:
+                pixels = []
+                for value in row:
+                    pixels.extend(unpacked[value])
+                # Leaves out the padding at the end of the row
+                colors.update(pixels[:self.width])
+        elif bits == 8:
+            for row in self.rows:
+                colors.update(row)
+        else:
+            size = bits // 8
+            for row in self.rows:
+                colors.update(bytes(row[i:i + size]) for i in range(0, len(row), size))
+        return len(colors)
+
+    def count_tiles(self):
+        """Counts the distinct 8x8 tiles; tiles are compared by the bytes of their rows, through a hashed set"""
+        segment = TILE_SIZE * self.bits_per_pixel // 8
+        stride = (self.width * self.bits_per_pixel + 7) // 8
+        tiles = set()
+        for y in range(0, self.height, TILE_SIZE):
+            band = [bytes(row) for row in self.rows[y:y + TILE_SIZE]]
+            for x in range(0, stride, segment):
+                tiles.add(b''.join(row[x:x + segment] for row in band))
+        return len(tiles)
+
+def read_png(data):
+    """Decodes the PNG in data, returning a PngImage"""
+    if data[:8] != PNG_SIGNATURE:
+        raise PngError('not a PNG file')
+
+    header = None
+    compressed = []
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if kind == b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'IDAT':
+            compressed.append(chunk)
+        elif kind == b'IEND':
+            break
+
+    if header is None:
+        raise PngError('missing the image header')
+
+    width, height, bit_depth, color_type, compression, filter_method, interlace = header
+    if not color_type in PNG_CHANNELS:
+        raise PngError('unknown color type {0}'.format(color_type))
+    if interlace:
+        raise PngError('interlaced images are not supported')
+
+    try:
+        raw = bytearray(zlib.decompress(b''.join(compressed)))
+    except zlib.error as e:
+        raise PngError('corrupted image data ({0})'.format(e))
+
+    bits_per_pixel = bit_depth * PNG_CHANNELS[color_type]
+    stride = (width * bits_per_pixel + 7) // 8
+    if len(raw) < (stride + 1) * height:
+        raise PngError('truncated image data')
+
+    rows = _unfilter(raw, height, stride, max(1, bits_per_pixel // 8))
+    return PngImage(width, height, bit_depth, color_type, rows)
+
+def _unfilter(raw, height, stride, bpp):
+    """Reverses the per-scanline filters"""
+    rows = []
+    prev = bytearray(stride)
+    pos = 0
+    for y in range(height):
+        filter_type = raw[pos]
+        line = raw[pos + 1:pos + 1 + stride]
+        pos += stride + 1
+
+        if filter_type == 1:
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xff
+        elif filter_type == 2:
+            for i in range(stride):
+                line[i] = (line[i] + prev[i]) & 0xff
+        elif filter_type == 3:
+            for i in range(stride):
+                left = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prev[i]) >> 1)) & 0xff
+        elif filter_type == 4:
+            for i in range(stride):
+                a = line[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    line[i] = (line[i] + a) & 0xff
+                elif pb <= pc:
+                    line[i] = (line[i] + b) & 0xff
+                else:
+                    line[i] = (line[i] + c) & 0xff
+        elif filter_type != 0:
+            raise PngError('unknown filter type {0}'.format(filter_type))
+
+        rows.append(line)
+        prev = line
+
+    return rows
+
+def analyse_image(data):
+    """Checks an image against SAM's limits, returning a report"""
+    report = {'width': None, 'height': None, 'colors': None, 'tiles': None, 'errors': []}
+    try:
+        image = read_png(data)
+    except PngError as e:
+        report['errors'].append(str(e))
+        return report
+
+    report['width'] = image.width
+    report['height'] = image.height
+    report['colors'] = image.count_colors()
+    report['tiles'] = image.count_tiles()
+
+    if (image.width, image.height) != (IMAGE_WIDTH, IMAGE_HEIGHT):
+        report['errors'].append('the size is {0}x{1}, but it must be {2}x{3}'.format(image.width, image.height, IMAGE_WIDTH, IMAGE_HEIGHT))
+    if report['colors'] > MAX_COLORS:
+        report['errors'].append('it has {0} colors, but there can be no more than {1}'.format(report['colors'], MAX_COLORS))
+    if report['tiles'] > MAX_TILES:
+        report['errors'].append('it has {0} distinct tiles, but there can be no more than {1}'.format(report['tiles'], MAX_TILES))
+
+    return report
+
+def describe_report(report):
+    if report['width'] is None:
+        return 'unreadable'
+    return '{0}x{1}, {2}/{3} colors, {4}/{5} tiles'.format(
+        report['width'], report['height'], report['colors'], MAX_COLORS, report['tiles'], MAX_TILES)
+
+class ImageChecker(object):
+    """Checks images, caching the reports by the hash of the files' contents"""
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.reports = {}
+        self.analysed = 0
+        self._load()
+
+    def check(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            return {'width': None, 'height': None, 'colors': None, 'tiles': None, 'errors': ['can\'t be read ({0})'.format(e)]}
+
+        digest = hashlib.sha1(data).hexdigest()
+        report = self.reports.get(digest)
+        if report is None:
+            report = self.reports[digest] = analyse_image(data)
+            self.analysed += 1
+        return report
+
+    def save(self):
+        if not self.cache_path or not self.analysed:
+            return
+        data = {'version': __version__, 'images': self.reports}
+        with io.open(self.cache_path, 'w', encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(data, indent=1, sort_keys=True, separators=(',', ': ')))
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+
+        try:
+            with io.open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError:
+            log.warning('twee2sam: ignoring corrupted image cache "{0}"'.format(self.cache_path))
+            return
+
+        if data.get('version') == __version__:
+            self.reports = data['images']
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import io, os, json
+import logging
+
+__version__ = "0.1"
+
+log = logging.getLogger('twee2sam')
+
+MANIFEST_NAME = 'twee2sam.manifest.json'
+
+class BuildManifest(object):
+    """Remembers what the previous build generated, so that unchanged scripts can be kept
+
+    Without a destination, as when compiling in memory, there's nothing to load or save.
+    """
+
+    def __init__(self, destination):
+        self.path = os.path.join(destination, MANIFEST_NAME) if destination else None
+        self.compiler = None
+        self.output = None
+        self.passages = {}
+        self.variables = None
+        self.images = []
+        self.music = []
+
+    def load(self):
+        """Loads the manifest from the destination; returns False if there's no usable manifest"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+
+        try:
+            with io.open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError:
+            log.warning('twee2sam: ignoring corrupted build manifest "{0}"'.format(self.path))
+            return False
+
+        if data.get('version') != __version__:
+            return False
+
+        self.compiler = data['compiler']
+        self.output = data.get('output')
+        self.passages = data['passages']
+        self.variables = data['variables']
+        self.images = data['images']
+        self.music = data['music']
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            'version': __version__,
+            'compiler': self.compiler,
+            'output': self.output,
+            'passages': self.passages,
+            'variables': self.variables,
+            'images': self.images,
+            'music': self.music
+        }
+        with io.open(self.path, 'w', encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(data, indent=1, sort_keys=True, separators=(',', ': ')))
+
+    def passage_indexes(self):
+        return dict((title, entry['index']) for title, entry in self.passages.items())
+
+    def is_current(self, title, key):
+        entry = self.passages.get(title)
+        return entry is not None and entry['key'] == key
+
+    def record(self, title, index, key):
+        self.passages[title] = {'index': index, 'key': key}
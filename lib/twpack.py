@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import io, os, struct, zipfile
+
+__version__ = "0.1"
+
+PACK_NAME = 'scripts.twpack'
+
+# The pack starts with the magic and the number of files, followed by the index
+# and then by the contents of every file, one after the other. Each index entry
+# holds the offset (from the start of the pack) and the size of a file, and the
+# length of its name, followed by the name itself. Numbers are little endian,
+# and both names and contents are UTF-8.
+PACK_MAGIC = b'TWPACK1\n'
+PACK_HEADER = struct.Struct('<I')
+PACK_ENTRY = struct.Struct('<IIH')
+
+class PackError(Exception):
+    """Raised for files that aren't valid packs"""
+
+# Every output has the same methods: write(name, text), exists(name), remove(name),
+# copy_assets(copies, copier), taking a list of (source path, name) pairs, and close().
+
+class DirectoryOutput(object):
+    """Writes each generated file into the destination directory right away"""
+
+    def __init__(self, destination):
+        self.destination = destination
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+
+    def write(self, name, text):
+        with io.open(os.path.join(self.destination, name), 'w', encoding="utf-8") as f:
+            f.write(text)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.destination, name))
+
+    def remove(self, name):
+        path = os.path.join(self.destination, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def copy_assets(self, copies, copier):
+        copier.copy_all([(source, os.path.join(self.destination, name)) for source, name in copies])
+
+    def close(self):
+        pass
+
+class PackOutput(object):
+    """Keeps the generated files in memory, and writes them all into a single pack when closed
+
+    With keep set, the files already in the pack are kept, unless they're written or removed again.
+    """
+
+    def __init__(self, path, keep=False):
+        self.path = path
+        self.files = {}
+        if keep and os.path.exists(path):
+            try:
+                self.files = read_pack(path)
+            except PackError:
+                pass
+
+    def write(self, name, text):
+        self.files[name] = text.encode('utf-8')
+
+    def exists(self, name):
+        return name in self.files
+
+    def remove(self, name):
+        self.files.pop(name, None)
+
+    def keep_scripts(self, names):
+        """Drops the scripts that aren't among the names, such as the ones a reused pack still has from an older build"""
+        for name in [name for name in self.files if name.endswith('.twsam') and not name in names]:
+            del self.files[name]
+
+    def copy_assets(self, copies, copier):
+        # SAM wants the assets as files of their own, next to the pack
+        destination = os.path.dirname(self.path)
+        copier.copy_all([(source, os.path.join(destination, name)) for source, name in copies])
+
+    def close(self):
+        write_pack(self.path, self.files)
+
+class MemoryOutput(object):
+    """Keeps the generated files in memory, as a dict of names and texts
+
+    The assets aren't copied; 'assets' maps their names to the paths they'd be copied from.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.assets = {}
+
+    def write(self, name, text):
+        self.files[name] = text
+
+    def exists(self, name):
+        return name in self.files
+
+    def remove(self, name):
+        self.files.pop(name, None)
+
+    def copy_assets(self, copies, copier):
+        self.assets.update((name, source) for source, name in copies)
+
+    def close(self):
+        pass
+
+class ZipOutput(MemoryOutput):
+    """Keeps the generated files in memory, and writes them into a zip file when closed, along with the assets
+
+    The path can also be a file object, such as an io.BytesIO.
+    """
+
+    def __init__(self, path):
+        MemoryOutput.__init__(self)
+        self.path = path
+
+    def close(self):
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in sorted(self.files):
+                archive.writestr(name, self.files[name].encode('utf-8'))
+            for name in sorted(self.assets):
+                archive.write(self.assets[name], name)
+
+def write_pack(path, files):
+    """Writes a pack out of a dict of file names and contents, with a single write"""
+    names = sorted(files)
+    encoded = [name.encode('utf-8') for name in names]
+
+    offset = len(PACK_MAGIC) + PACK_HEADER.size + sum(PACK_ENTRY.size + len(name) for name in encoded)
+    parts = [PACK_MAGIC, PACK_HEADER.pack(len(names))]
+    for name, encoded_name in zip(names, encoded):
+        parts.append(PACK_ENTRY.pack(offset, len(files[name]), len(encoded_name)))
+        parts.append(encoded_name)
+        offset += len(files[name])
+    parts.extend(files[name] for name in names)
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(parts))
+
+def read_pack(path):
+    """Returns a dict with the names and contents of the files in a pack"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise PackError('"{0}" is not a pack'.format(path))
+
+    try:
+        pos = len(PACK_MAGIC)
+        count, = PACK_HEADER.unpack_from(data, pos)
+        pos += PACK_HEADER.size
+
+        files = {}
+        for i in range(count):
+            offset, size, name_length = PACK_ENTRY.unpack_from(data, pos)
+            pos += PACK_ENTRY.size
+            name = data[pos:pos + name_length].decode('utf-8')
+            pos += name_length
+            if offset + size > len(data):
+                raise PackError('"{0}" is truncated'.format(path))
+            files[name] = data[offset:offset + size]
+    except struct.error:
+        raise PackError('"{0}" has a corrupted index'.format(path))
+
+    return files
+
+def unpack(path, destination):
+    """Writes the files in a pack into the destination, just as they'd have been written without packing; returns how many there were"""
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+
+    output = DirectoryOutput(destination)
+    files = read_pack(path)
+    for name, contents in files.items():
+        output.write(name, contents.decode('utf-8'))
+    return len(files)
@@ -1,44 +1,201 @@
 # -*- coding: utf-8 -*-
 
-import sys, re
+import sys, os, re
+import hashlib
 import logging
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import twexpression
+from twprofile import Profiler
+from twreader import TiddlerRecord
 
-__version__ = "0.2"
+__version__ = "0.3"
+
+log = logging.getLogger('twee2sam')
+
+AST_CACHE_NAME = 'twee2sam.ast.cache'
 
 class TwParser(object):
-    """Parses a TiddlyWiki object into an AST"""
+    """Parses tiddlers into an AST
+
+    The tiddlers can be anything with a title and a text: the TiddlerRecords
+    read_twee yields, or the values of a TiddlyWiki's tiddlers. If a title
+    comes up more than once, the first passage is kept, as TiddlyWiki did,
+    and the others are reported.
 
-    def __init__(self, tw):
+    Given the parser of a previous run, or an AstCache, the passages whose
+    text didn't change are taken from it instead of being parsed again; the
+    cache is then updated with whatever had to be parsed.
+    """
+
+    def __init__(self, tiddlers, jobs=1, profiler=None, previous=None, cache=None):
         self.passages = {}
-        self._parse(tw)
+        self.jobs = jobs
+        self.profiler = profiler or Profiler(False)
+        self.previous = previous.passages if previous else cache.passages if cache else {}
+        self.reparsed = 0
+        try:
+            self._parse(tiddlers)
+        finally:
+            # The names are only shared within a parse; --watch, --batch and compile_story() would otherwise keep every name ever parsed
+            _names.clear()
+
+        if cache and (self.reparsed or len(cache.passages) != len(self.passages)):
+            cache.save(self.passages)
 
     def __repr__(self):
 #		return "<TwParser\n" + '\n'.join(["\t" + str(psg) for psg in self.passages.values()]) + ">"
         return "<TwParser {0}>".format(ident_list(self.passages.values()))
 
-    def _parse(self, tw):
-        """Parses the TiddlyWiki object"""
-        for tiddler in tw.tiddlers.values():
+    def _parse(self, tiddlers):
+        """Parses the tiddlers as they come"""
+        tiddlers = skip_duplicates(tiddlers)
+        if self.jobs > 1:
+            self._parse_in_parallel(tiddlers)
+            return
+
+        for tiddler in tiddlers:
             self._parse_tiddler(tiddler)
 
+    def _parse_in_parallel(self, tiddlers):
+        """Parses the tiddlers over a process pool, keeping their original order"""
+        records = [TiddlerRecord(tiddler.title, tiddler.text) for tiddler in tiddlers]
+        kept = [self._unchanged(record) for record in records]
+        changed = [record for record, passage in zip(records, kept) if passage is None]
+
+        parsed = iter([])
+        if changed:
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                chunk_size = max(1, len(changed) // (self.jobs * 4))
+                parsed = iter(pool.map(Passage, changed, chunk_size))
+            finally:
+                pool.close()
+                pool.join()
+
+        for passage in kept:
+            if passage is None:
+                passage = next(parsed)
+                self.reparsed += 1
+            self.passages[passage.title] = passage
+
     def _parse_tiddler(self, tiddler):
         """Parses a Tiddler object"""
-        passage = Passage(tiddler)
+        passage = self._unchanged(tiddler)
+        if passage is None:
+            with self.profiler.passage(tiddler.title, 'parse'):
+                passage = Passage(tiddler)
+            self.reparsed += 1
         self.passages[passage.title] = passage
 
+    def _unchanged(self, tiddler):
+        """Returns the passage from the previous run if the tiddler's text is still the same"""
+        passage = self.previous.get(tiddler.title)
+        if passage is not None and passage.digest == text_digest(tiddler.text):
+            return passage
+        return None
+
+def skip_duplicates(tiddlers):
+    """Yields the tiddlers whose titles haven't come up before"""
+    titles = set()
+    for tiddler in tiddlers:
+        if tiddler.title in titles:
+            log.warning('twee2sam: passage "{0}" is defined more than once; only the first one is kept'.format(tiddler.title))
+            continue
+        titles.add(tiddler.title)
+        yield tiddler
+
+
+class AstCache(object):
+    """Keeps the parsed passages on disk between runs, along with the parsed expressions
+
+    The passages are matched by title and text digest; the whole cache is thrown
+    away when the parser, the expression parser or the version of Python changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.passages = {}
+        self._load()
+
+    @staticmethod
+    def version():
+        return '{0}/{1}/{2}.{3}'.format(__version__, twexpression.__version__, *sys.version_info[:2])
+
+    def save(self, passages):
+        self.passages = passages
+        data = {
+            'version': AstCache.version(),
+            'passages': passages,
+            'expressions': twexpression.parsed_expressions()
+        }
+
+        # Written aside and then moved into place, so that builds sharing the cache never see half of it
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(self.path)
+            os.rename(temp_path, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            log.warning('twee2sam: ignoring unreadable AST cache "{0}" ({1})'.format(self.path, e))
+            return
+
+        if not isinstance(data, dict) or data.get('version') != AstCache.version():
+            return
+
+        self.passages = data['passages']
+        twexpression.preload_parsed_expressions(data['expressions'])
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# Kinds, titles, targets and paths come up over and over; this keeps a single copy of each, until the parser is done
+# (intern() is no use here: on Python 2, it only takes byte strings)
+_names = {}
+
+def intern_name(name):
+    return _names.setdefault(name, name)
+
 
 class Passage(object):
     """Represents a parsed passage"""
 
+    __slots__ = ('title', 'digest', 'commands', '_block_stack')
+
     RE_ITEM_LIST = re.compile(r'^([#\*])\s(.*)$', flags=re.MULTILINE)
     RE_MACRO = re.compile(r'\<\<(\w+)(\s*.*?)\>\>')
     RE_LINK = re.compile(r'\[\[(.*?)\]\]')
     RE_IMG = re.compile(r'\[img\[(.*?)\]\]')
     RE_TEXT = re.compile(r'(.*)', flags=re.DOTALL)
 
+    # The rules are tried in order; each one only sees the text the previous ones left unmatched
+    TOKEN_RULES = (
+        (RE_ITEM_LIST, 'list', 1),
+        (RE_MACRO, 'mc', 0),
+        (RE_IMG, 'im', 0),
+        (RE_LINK, 'lk', 0),
+        (RE_TEXT, 'tx', 0)
+    )
+
     def __init__(self, tiddler):
-        self.title = tiddler.title
+        self.title = intern_name(tiddler.title)
+        self.digest = text_digest(tiddler.text)
         self.commands = []
         self._parse(tiddler)
 
@@ -51,30 +208,55 @@ class Passage(object):
         self.commands += self._parse_commands(tokens)
 
     def _parse_commands(self, tokens):
+        """Parses the tokens in a single pass; open blocks are kept on an explicit stack instead of recursing"""
         commands = []
-        close_block = False
 
-        while tokens and not close_block:
-            token = tokens.pop(0)
+        # Each frame is (commands of the block, where its tokens come from, token that opened it, its macro)
+        # <<if>> blocks share their parent's tokens, while lists bring their own.
+        frames = [(commands, iter(tokens), None, None)]
+        while frames:
+            block_commands, source, opener, block_macro = frames[-1]
+            token = next(source, None)
+            if token is None:
+                self._close_block(frames)
+                continue
+
             tk_type = token[0]
             if tk_type == 'tx':
-                commands.append(TextCmd(token))
+                # Blank text shows nothing on SAM, so it isn't worth keeping
+                if token[1].strip():
+                    block_commands.append(TextCmd(token))
             elif tk_type == 'mc':
-                macro = self._parse_macro(token, tokens)
-                if macro:
-                    if isinstance(macro, EndMacro):
-                        close_block = True
-                    else:
-                        commands.append(macro)
+                macro = self._parse_macro(token)
+                if isinstance(macro, IfMacro):
+                    frames.append(([], source, token, macro))
+                elif isinstance(macro, EndMacro):
+                    self._close_block(frames)
+                elif macro:
+                    block_commands.append(macro)
             elif tk_type == 'im':
-                commands.append(ImageCmd(token))
+                block_commands.append(ImageCmd(token))
             elif tk_type == 'lk':
-                commands.append(LinkCmd(token))
+                block_commands.append(LinkCmd(token))
             elif tk_type in ('ul','ol'):
-                commands.append(ListCmd(token, self._parse_commands(token[1])))
+                frames.append(([], iter(token[1]), token, None))
 
         return commands
 
+    def _close_block(self, frames):
+        """Closes the innermost block, adding the resulting command to the enclosing one"""
+        block_commands, source, opener, block_macro = frames.pop()
+        if opener is None:
+            return
+
+        if block_macro:
+            block_macro.children = block_commands
+            command = self._check_macro(opener, block_macro)
+        else:
+            command = ListCmd(opener, block_commands)
+
+        frames[-1][0].append(command)
+
     # Well, it's not really a tokenizer, more like a 1st level parser, but meh.
     def _tokenize(self, tiddler):
         # Remove the line continuations (\ followed by line break)
@@ -82,64 +264,53 @@ class Passage(object):
         return self._tokenize_string(source)
 
     def _tokenize_string(self, string):
-        def test_command(string, remaining_tests):
-            # Determine what will be checked
-            if not remaining_tests:
-                return []
-
-            regex, action, skipped_chars = remaining_tests[0]
-            remaining_tests = remaining_tests[1:]
-
-            # Starts checking for snippets matching the regex
-            tokens = []
+        """Lazily yields (kind, value, start, end) tokens from a single pass over the string"""
+        rules = Passage.TOKEN_RULES
+        text_level = len(rules) - 1
+
+        # Each frame scans a span with one rule: [level, matches, position, end, match waiting for its preceding text]
+        stack = [[0, rules[0][0].finditer(string), 0, len(string), None]]
+        while stack:
+            frame = stack[-1]
+            level, matches, pos, end, waiting = frame
+            if waiting:
+                frame[4] = None
+                yield self._make_token(rules[level][1], waiting)
+
+            match = next(matches, None)
+            if match:
+                gap_end = match.start()
+                frame[2] = match.end() + rules[level][2]
+            else:
+                # Processes remaining text, if any.
+                stack.pop()
+                gap_end = end
 
-            st_pos = 0
-            st_len = len(string)
-            for item in regex.finditer(string):
+            if pos < gap_end and pos < end:
                 # Processes preceding non-matching text
-                it_st = item.start()
-                if st_pos < it_st and st_pos < st_len:
-                    tokens += test_command(string[st_pos:it_st], remaining_tests)
-                st_pos = item.end() + skipped_chars
-
-                # Executes the action
-                tokens += action(item)
-
-            # Processes remaining text, if any.
-            if st_pos < st_len:
-                tokens += test_command(string[st_pos:st_len], remaining_tests)
-
-            return tokens
-
-        def process_item_list(match):
-            kind = match.group(1)
-            contents = match.group(2)
-            list_type = 'ul' if kind == '*' else 'ol'
-            return [(list_type, self._tokenize_string(contents.strip()))]
-
-        def process_macro(match):
-            return [('mc', (match.group(1), match.group(2)))]
-
-        def process_image(match):
-            return [('im', match.group(1))]
-
-        def process_link(match):
-            return [('lk', match.group(1))]
-
-        def process_text(match):
-            return [('tx', match.group(1))]
-
-        tests = [
-            (Passage.RE_ITEM_LIST, process_item_list, 1),
-            (Passage.RE_MACRO, process_macro, 0),
-            (Passage.RE_IMG, process_image, 0),
-            (Passage.RE_LINK, process_link, 0),
-            (Passage.RE_TEXT, process_text, 0)
-        ]
-
-        return test_command(string, tests)
+                if level + 1 == text_level:
+                    # RE_TEXT would also match the empty string at the end of the text
+                    yield ('tx', string[pos:gap_end], pos, gap_end)
+                    yield ('tx', string[gap_end:gap_end], gap_end, gap_end)
+                else:
+                    stack.append([level + 1, rules[level + 1][0].finditer(string, pos, gap_end), pos, gap_end, None])
+                    frame[4] = match
+                    continue
+
+            if match:
+                yield self._make_token(rules[level][1], match)
+
+    def _make_token(self, kind, match):
+        if kind == 'list':
+            list_type = 'ul' if match.group(1) == '*' else 'ol'
+            contents = list(self._tokenize_string(match.group(2).strip()))
+            return (list_type, contents, match.start(), match.end())
+        elif kind == 'mc':
+            return (kind, (match.group(1), match.group(2)), match.start(), match.end())
+        else:
+            return (kind, match.group(1), match.start(), match.end())
 
-    def _parse_macro(self, token, tokens):
+    def _parse_macro(self, token):
         kind, params = token[1]
         if kind == 'set':
             macro = SetMacro(token)
@@ -148,7 +319,9 @@ class Passage(object):
         elif kind == 'pause':
             macro = PauseMacro(token)
         elif kind == 'if':
-            macro = self._parse_if(token, tokens)
+            # Its children come next; it's only checked once its block is closed
+            self._block_stack.append(IfMacro(token))
+            return self._block_stack[-1]
         elif kind == 'call':
             macro = CallMacro(token)
         elif kind == 'jump':
@@ -168,23 +341,26 @@ class Passage(object):
         else:
             macro = InvalidMacro(token, 'unknown macro: ' + kind)
 
+        return self._check_macro(token, macro)
+
+    def _check_macro(self, token, macro):
         if macro and macro.error:
             self._warning(macro.error)
             return InvalidMacro(token, macro.error)
 
         return macro
 
-    def _parse_if(self, token, tokens):
-        if_macro = IfMacro(token)
-        self._block_stack.append(if_macro)
-        if_macro.children = self._parse_commands(tokens)
-        return if_macro
-
     def _warning(self, msg):
-        logging.warning("'{0}': {1}".format(self.title, msg))
+        log.warning("'{0}': {1}".format(self.title, msg))
 
 class AbstractCmd(object):
-    """Base class for the different kinds of commands"""
+    """Base class for the different kinds of commands
+
+    There can be hundreds of thousands of commands in a story, so every class
+    declares its attributes in __slots__.
+    """
+
+    __slots__ = ('kind', 'children')
 
     def __init__(self, kind, token, children=None):
         self.kind = kind
@@ -197,6 +373,8 @@ class AbstractCmd(object):
 class TextCmd(AbstractCmd):
     """Class for text commands"""
 
+    __slots__ = ('text',)
+
     def __init__(self, token):
         AbstractCmd.__init__(self, 'text', token)
 
@@ -210,6 +388,8 @@ class TextCmd(AbstractCmd):
 class ImageCmd(AbstractCmd):
     """Class for image commands"""
 
+    __slots__ = ('path',)
+
     def __init__(self, token):
         AbstractCmd.__init__(self, 'image', token)
 
@@ -217,12 +397,14 @@ class ImageCmd(AbstractCmd):
         return '<cmd {0}{1}>'.format(self.kind, ident_list([self.path]))
 
     def _parse(self, token):
-        self.path = token[1]
+        self.path = intern_name(token[1])
 
 
 class LinkCmd(AbstractCmd):
     """Class for link commands"""
 
+    __slots__ = ('target', 'label', 'on_click')
+
     def __init__(self, token):
         AbstractCmd.__init__(self, 'link', token)
 
@@ -237,10 +419,10 @@ class LinkCmd(AbstractCmd):
 
         lbl_tgt = link_action[0].split('|')
         if len(lbl_tgt) > 1:
-            self.target = lbl_tgt[-1]
+            self.target = intern_name(lbl_tgt[-1])
             self.label = '|'.join(lbl_tgt[:-1])
         else:
-            self.target = link_action[0]
+            self.target = intern_name(link_action[0])
             self.label = None
 
     def actual_label(self):
@@ -250,6 +432,8 @@ class LinkCmd(AbstractCmd):
 class ListCmd(AbstractCmd):
     """Class for list commands"""
 
+    __slots__ = ('ordered',)
+
     def __init__(self, token, children):
         AbstractCmd.__init__(self, 'list', token, children)
 
@@ -262,13 +446,15 @@ class ListCmd(AbstractCmd):
 class AbstractMacro(AbstractCmd):
     """Class for macros """
 
+    __slots__ = ('params', 'error', 'target', 'expr')
+
     RE_EXPRESSION = re.compile(r'(not\s+|\!\s*|)(true|false|[A-Z0-9_\$]+)', flags=re.IGNORECASE)
     RE_PRINT = re.compile(r'(\$[A-Za-z0-9_]+)', flags=re.IGNORECASE)
 
-    def __init__(self, token, children=[]):
+    def __init__(self, token, children=None):
         self.params = token[1][1]
         self.error = None
-        AbstractCmd.__init__(self, token[1][0], token, children)
+        AbstractCmd.__init__(self, intern_name(token[1][0]), token, children)
 
     def __repr__(self):
         return '<cmd {0}{1}>'.format(self.kind, ident_list([self.text]))
@@ -285,6 +471,8 @@ class AbstractMacro(AbstractCmd):
 class InvalidMacro(AbstractMacro):
     """Class for invalid macros"""
 
+    __slots__ = ()
+
     def __init__(self, token, error=None):
         AbstractMacro.__init__(self, token)
         self.kind = 'invalid'
@@ -293,6 +481,8 @@ class InvalidMacro(AbstractMacro):
 class SetMacro(AbstractMacro):
     """Class for the 'set' macro"""
 
+    __slots__ = ()
+
     RE_ATTRIBUTION = re.compile(r'\s*([\w\$]+)\s*(?:=|\sto\s)\s*(.*)')
 
     def _parse(self, token):
@@ -303,15 +493,19 @@ class SetMacro(AbstractMacro):
             self.error = 'invalid "set" expression: ' + params
             return
 
-        self.target = match.group(1)
+        self.target = intern_name(match.group(1))
         self.expr = self._parse_expression(match.group(2))
 
 class PauseMacro(AbstractMacro):
     """Class for the 'pause' macro"""
 
+    __slots__ = ()
+
 class PrintMacro(AbstractMacro):
     """Class for a 'print' macro which displays the value of a variable"""
 
+    __slots__ = ()
+
     def _parse(self, token):
         kind, params = token[1]
         self.expr = self._parse_expression(params.lstrip())
@@ -320,9 +514,11 @@ class PrintMacro(AbstractMacro):
 class DisplayMacro(AbstractMacro):
     """Class for the 'display' macro"""
 
+    __slots__ = ()
+
     def _parse(self, token):
         kind, params = token[1]
-        self.target = params.replace('"', '').strip()
+        self.target = intern_name(params.replace('"', '').strip())
 
     def __repr__(self):
         return "<cmd display: {0}>".format(self.target)
@@ -330,6 +526,8 @@ class DisplayMacro(AbstractMacro):
 class CallMacro(AbstractMacro):
     """Class for a jump/call subroutine macro"""
 
+    __slots__ = ()
+
     RE_CALL = re.compile(r'\s*([A-Za-z0-9_]+)\s*$')
 
     def _parse(self, token):
@@ -338,22 +536,28 @@ class CallMacro(AbstractMacro):
 
         match = CallMacro.RE_CALL.match(params.lstrip().rstrip())
         if match:
-            logging.info("CallMacro: Call subroutine %s %s" % (kind, params))
-            self.target = match.group(1)
+            log.info("CallMacro: Call subroutine %s %s" % (kind, params))
+            self.target = intern_name(match.group(1))
             self.expr = self.target
             return
 
+        self.error = 'invalid "{0}" target: {1}'.format(kind, params)
+
 class ReturnMacro(AbstractMacro):
     """Class for a return-from-subroutine macro"""
 
+    __slots__ = ()
+
     def _parse(self, token):
-        logging.info("ReturnMacro: Return from subroutine")
+        log.info("ReturnMacro: Return from subroutine")
         self.expr = True
         return
 
 class IfMacro(AbstractMacro):
     """Class for the 'if' macro"""
 
+    __slots__ = ('else_block',)
+
     def _parse(self, token):
         kind, params = token[1]
         self.expr = self._parse_expression(params)
@@ -363,12 +567,28 @@ class IfMacro(AbstractMacro):
 class EndMacro(AbstractMacro):
     """Class for closing the current macro"""
 
+    __slots__ = ()
+
 class MusicMacro(AbstractMacro):
     """Class for the 'music' macro"""
 
+    __slots__ = ('path',)
+
     def _parse(self, token):
         kind, params = token[1]
-        self.path = params.replace('"', '').strip()
+        self.path = intern_name(params.replace('"', '').strip())
+
+def iter_commands(commands):
+    """Iterates depth-first over the commands and all of their children"""
+    pending = [iter(commands)]
+    while pending:
+        for cmd in pending[-1]:
+            yield cmd
+            if cmd.children:
+                pending.append(iter(cmd.children))
+            break
+        else:
+            pending.pop()
 
 def ident_list(list):
     parts = []
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import re, heapq, hashlib
+from collections import defaultdict
+
+__version__ = "0.1"
+
+# What it takes, in bytes, to call a phrase's script instead of printing it: closing the string before, "<index>c\n", and opening it again
+CALL_COST = 8
+
+# What a phrase's own script takes on top of the phrase: the quotes, the return, and its line on the script list
+SCRIPT_COST = 20
+
+# SAM has to keep every script on the list, so the dictionary can't grow forever
+MAX_PHRASES = 256
+
+# Longest phrase, in words, that's looked for
+MAX_WORDS = 12
+
+# A word along with the spaces after it, or the spaces the text starts with
+RE_WORD = re.compile(u'\\S+\\s*|\\s+', re.UNICODE)
+
+def find_phrases(texts, max_phrases=MAX_PHRASES):
+    """Picks the runs of words that save the most by being printed from scripts of their own
+
+    Runs of n words are only counted where their first n-1 words were already frequent enough, so that
+    the long runs don't have to be counted everywhere. Then the phrases are picked greedily: each one
+    is counted again on what the phrases picked before it left of the texts, which is also how
+    PhraseTable.split() applies them.
+    """
+    texts = list(texts)
+    tokenized = [RE_WORD.findall(text) for text in texts]
+
+    # The runs of n words still worth extending, as (text, where it starts, run)
+    runs = [(t, i, word) for t, words in enumerate(tokenized) for i, word in enumerate(words)]
+
+    # The runs that would save something, and the texts they're found in
+    savings = {}
+    holders = {}
+    for n in range(1, MAX_WORDS + 1):
+        found = defaultdict(list)
+        for t, i, run in runs:
+            found[run].append(t)
+
+        frequent = set(run for run, found_in in found.items() if len(found_in) > 1)
+        if not frequent:
+            break
+
+        for phrase in frequent:
+            saved = _saving(phrase, len(found[phrase]))
+            if saved > 0:
+                savings[phrase] = saved
+                holders[phrase] = sorted(set(found[phrase]))
+
+        runs = [(t, i, run + tokenized[t][i + n]) for t, i, run in runs if run in frequent and i + n < len(tokenized[t])]
+
+    # What's left of each text once the picked phrases are taken out
+    remains = [[text] for text in texts]
+
+    # Savings only go down as phrases are picked, so a phrase that still saves more than the next one's old saving is the best
+    heap = [(-saved, phrase) for phrase, saved in savings.items()]
+    heapq.heapify(heap)
+    phrases = []
+    while heap and len(phrases) < max_phrases:
+        saved, phrase = heapq.heappop(heap)
+        saved = _saving(phrase, sum(piece.count(phrase) for t in holders[phrase] for piece in remains[t]))
+        if saved <= 0:
+            continue
+        if heap and saved < -heap[0][0]:
+            heapq.heappush(heap, (-saved, phrase))
+            continue
+
+        phrases.append(phrase)
+        for t in holders[phrase]:
+            remains[t] = [part for piece in remains[t] for part in piece.split(phrase)]
+
+    return phrases
+
+def _saving(phrase, count):
+    return count * (len(phrase) - CALL_COST) - (len(phrase) + SCRIPT_COST)
+
+class PhraseTable(object):
+    """The phrases that are printed by scripts of their own, numbered from the index of the first one's script"""
+
+    def __init__(self, phrases, first_index):
+        self.phrases = list(phrases)
+        self.first_index = first_index
+        self.indexes = dict((phrase, first_index + i) for i, phrase in enumerate(self.phrases))
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def split(self, text):
+        """Splits the text into the indexes of the phrases' scripts and the strings in between
+
+        The phrases are taken out in the order they were picked.
+        """
+        pieces = [text]
+        for phrase in [phrase for phrase in self.phrases if phrase in text]:
+            split = []
+            for piece in pieces:
+                if isinstance(piece, int) or not phrase in piece:
+                    split.append(piece)
+                    continue
+                parts = piece.split(phrase)
+                for part in parts[:-1]:
+                    if part:
+                        split.append(part)
+                    split.append(self.indexes[phrase])
+                if parts[-1]:
+                    split.append(parts[-1])
+            pieces = split
+        return pieces
+
+    def script(self, phrase):
+        """Returns the script printing the phrase"""
+        return u'"{0}"\n$\n'.format(phrase)
+
+    def size(self):
+        """Returns how many bytes the phrases' scripts take"""
+        return sum(len(self.script(phrase)) for phrase in self.phrases)
+
+    def digest(self):
+        key = hashlib.sha1(u'{0}'.format(self.first_index).encode('ascii'))
+        for phrase in self.phrases:
+            key.update(u'\n{0}'.format(phrase).encode('utf-8'))
+        return key.hexdigest()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import sys, io, json, time
+
+__version__ = "0.1"
+
+REPORT_NAME = 'twee2sam.profile.json'
+
+def allocated_blocks():
+    """Returns how many memory blocks the interpreter has allocated, or None if it can't tell"""
+    try:
+        return sys.getallocatedblocks()
+    except AttributeError:
+        return None
+
+class Profiler(object):
+    """Records the time and allocations spent on each phase of the build and on each passage
+
+    When it's not enabled, every method returns right away, so the calls can stay in place.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+        self.passages = {}
+        self._current = None
+
+    def phase(self, name):
+        """Ends the current phase, if any, and starts the next one"""
+        if not self.enabled:
+            return
+        self.finish()
+        self._current = (name, time.time(), allocated_blocks())
+
+    def finish(self):
+        """Ends the current phase"""
+        if not self._current:
+            return
+        name, start, blocks = self._current
+        self.phases.append({'name': name, 'time': time.time() - start, 'blocks': _blocks_since(blocks)})
+        self._current = None
+
+    def passage(self, title, cost):
+        """Returns a context manager that records what's spent inside it as a cost ('parse', 'codegen'...) of the passage"""
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _PassageScope(self, title, cost)
+
+    def report(self):
+        self.finish()
+        total = sum(phase['time'] for phase in self.phases)
+
+        passages = {}
+        cost_totals = {}
+        for title, costs in self.passages.items():
+            for cost, spent in costs.items():
+                cost_totals[cost] = cost_totals.get(cost, 0) + spent['time']
+            passages[title] = {
+                'time': sum(spent['time'] for spent in costs.values()),
+                'dominant': max(costs, key=lambda cost: costs[cost]['time']),
+                'costs': costs
+            }
+
+        return {
+            'version': __version__,
+            'time': total,
+            'phases': self.phases,
+            'costs': cost_totals,
+            'passages': passages
+        }
+
+    def save(self, path):
+        with io.open(path, 'w', encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(self.report(), indent=1, sort_keys=True, separators=(',', ': ')))
+
+    def summary(self, slowest=5):
+        """Returns a few lines telling where the time went"""
+        report = self.report()
+        total = report['time'] or 1
+
+        lines = []
+        lines.append('total {0:.3f}s; '.format(report['time']) + ', '.join(
+            '{0} {1:.3f}s ({2:.0%})'.format(phase['name'], phase['time'], phase['time'] / total) for phase in report['phases']))
+        if report['costs']:
+            lines.append('passages: ' + ', '.join(
+                '{0} {1:.3f}s'.format(cost, spent) for cost, spent in sorted(report['costs'].items(), key=lambda item: -item[1])))
+
+        passages = sorted(report['passages'].items(), key=lambda item: -item[1]['time'])
+        for title, passage in passages[:slowest]:
+            dominant = passage['dominant']
+            lines.append('slow passage "{0}": {1:.1f}ms, mostly {2} ({3:.1f}ms)'.format(
+                title, passage['time'] * 1000, dominant, passage['costs'][dominant]['time'] * 1000))
+
+        return lines
+
+def _blocks_since(blocks):
+    now = allocated_blocks()
+    return now - blocks if now is not None and blocks is not None else None
+
+class _PassageScope(object):
+
+    def __init__(self, profiler, title, cost):
+        self.profiler = profiler
+        self.title = title
+        self.cost = cost
+
+    def __enter__(self):
+        self.blocks = allocated_blocks()
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        blocks = _blocks_since(self.blocks)
+
+        costs = self.profiler.passages.setdefault(self.title, {})
+        spent = costs.setdefault(self.cost, {'time': 0, 'blocks': 0 if blocks is not None else None})
+        spent['time'] += elapsed
+        if blocks is not None:
+            spent['blocks'] += blocks
+
+class _NullScope(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_SCOPE = _NullScope()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import io, os, re, mmap
+from collections import namedtuple
+
+__version__ = "0.1"
+
+# Just what the parser needs from a tiddler; it's also cheap to send to another process
+TiddlerRecord = namedtuple('TiddlerRecord', 'title text')
+
+# Files at least this big are memory-mapped instead of read
+MMAP_THRESHOLD = 1024 * 1024
+
+UTF8_BOM = b'\xef\xbb\xbf'
+
+# A passage starts on every line beginning with '::'; any kind of line break counts, as it would when reading in text mode
+RE_HEADER = re.compile(u'(?:\r\n|\r|\n)(?=::)')
+RE_HEADER_BYTES = re.compile(b'(?:\r\n|\r|\n)(?=::)')
+RE_LINE_BREAK = re.compile(u'\r\n?')
+
+def read_twee(path, mmap_threshold=MMAP_THRESHOLD):
+    """Yields a TiddlerRecord for each passage of a twee file, as it goes through the file
+
+    Big files are memory-mapped, and only the passage being yielded gets decoded.
+    """
+    size = os.path.getsize(path)
+    if not size or size < mmap_threshold:
+        # Empty files can't be mapped
+        with io.open(path, encoding="utf-8-sig") as f:
+            for record in parse_twee(f.read()):
+                yield record
+        return
+
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = len(UTF8_BOM) if mapped[:len(UTF8_BOM)] == UTF8_BOM else 0
+        for chunk in _split(mapped, RE_HEADER_BYTES, start):
+            record = _record(RE_LINE_BREAK.sub(u'\n', chunk.decode('utf-8')))
+            if record:
+                yield record
+    finally:
+        mapped.close()
+
+def parse_twee(source):
+    """Yields a TiddlerRecord for each passage of the twee source"""
+    # read_twee drops the BOM while decoding, but text handed over as it was read still starts with it
+    if source.startswith(u'\ufeff'):
+        source = source[1:]
+    for chunk in _split(source, RE_HEADER):
+        record = _record(RE_LINE_BREAK.sub(u'\n', chunk))
+        if record:
+            yield record
+
+def _split(source, header_re, start=0):
+    """Yields the pieces of the source between passage headers"""
+    for match in header_re.finditer(source, start):
+        yield source[start:match.start()]
+        start = match.end()
+    yield source[start:]
+
+def _record(chunk):
+    """Reads a passage the way twee does: the title is on the first line, before any tags, and the rest is the text
+
+    Returns None for the blank space that may come before the first passage.
+    """
+    if not chunk.strip():
+        return None
+    header, _, text = chunk.partition(u'\n')
+    title = header.split(u'[')[0].strip(u' :')
+    return TiddlerRecord(title, text.strip())
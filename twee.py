@@ -86,7 +86,7 @@ def main (argv):
 
 	# the tiddlers
 
-	print TwParser(tw)
+	print TwParser(tw.tiddlers.values())
 
 #	print tw.toHtml()
 
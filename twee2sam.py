@@ -2,90 +2,476 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import argparse, sys, os, glob, re, shutil, io
+import argparse, sys, os, glob, re, io, time
+import hashlib
 import logging
+import multiprocessing
+import threading
+import itertools
+import cProfile
 from operator import itemgetter
-scriptPath = os.path.realpath(os.path.dirname(sys.argv[0]))
+# The modules are found next to this file, whether it's run as a script or imported
+scriptPath = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(scriptPath, 'tw'))
 sys.path.append(os.path.join(scriptPath, 'lib'))
-from tiddlywiki import TiddlyWiki
-from twparser import TwParser
+from twreader import read_twee, parse_twee
+from twparser import TwParser, AstCache, iter_commands
+from twmanifest import BuildManifest
+from twassets import AssetList, AssetCopier
+from twimages import ImageChecker, describe_report
+import twimages
+from twprofile import Profiler
+import twprofile
+from twpack import DirectoryOutput, PackOutput, MemoryOutput, ZipOutput
+import twpack
+from twphrases import PhraseTable, find_phrases
+import twbatch
 import twexpression
 
-__version__ = "0.8.0"
+__version__ = "0.9.1"
+
+# Everything the compiler reports goes through this logger; unless told otherwise, it only lets the warnings and errors through
+log = logging.getLogger('twee2sam')
+log.setLevel(logging.WARNING)
 
 def main (argv):
 
+    parser = option_parser()
+    opts = parser.parse_args()
+
+    # With --batch, the stories to compile come from the jobs file
+    if opts.batch:
+        run_batch(opts)
+        return
+
+    if not opts.sources or not opts.destination:
+        parser.error('the sources and the destination are required')
+
+    run(opts)
+
+def option_parser():
+    """Returns the parser of the command line; the options of each job of a batch are parsed with it as well"""
     parser = argparse.ArgumentParser(description="Convert twee source code into SAM source code")
     parser.add_argument("-a", "--author", default="twee")
     parser.add_argument("-m", "--merge", default="")
     parser.add_argument("-p", "--plugins", nargs="*", default=[])
     parser.add_argument("-r", "--rss", default="")
     parser.add_argument("-t", "--target", default="jonah")
-    parser.add_argument("sources")
-    parser.add_argument("destination")
-    opts = parser.parse_args()
-
-    # construct a TW object
-
-    tw = TiddlyWiki(opts.author)
+    parser.add_argument("-i", "--incremental", action="store_true")
+    parser.add_argument("-w", "--watch", action="store_true")
+    parser.add_argument("--ast-cache", default="")
+    parser.add_argument("--pack", action="store_true")
+    parser.add_argument("--strip-unreachable", action="store_true")
+    parser.add_argument("--compress-text", action="store_true")
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--dedup-threshold", type=int, default=DEDUP_THRESHOLD)
+    parser.add_argument("--unpack", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-d", "--display", choices=["inline", "subroutine"], default="inline")
+    parser.add_argument("--menu-mode", choices=["chain", "table"], default="chain")
+    parser.add_argument("--asset-check", choices=["mtime", "hash"], default="mtime")
+    parser.add_argument("--hardlink-assets", action="store_true")
+    parser.add_argument("--skip-image-check", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--cprofile", default="")
+    parser.add_argument("--batch", default="")
+    parser.add_argument("sources", nargs="?")
+    parser.add_argument("destination", nargs="?")
+    return parser
+
+def run(opts):
+    """Compiles the story, or unpacks a pack, as the options tell"""
+
+    # For the SAM side: turns a pack back into the files SAM expects
+    if opts.unpack:
+        try:
+            count = twpack.unpack(opts.sources, opts.destination)
+        except (IOError, twpack.PackError) as e:
+            log.error('twee2sam: can\'t unpack: {0}'.format(e))
+            sys.exit(2)
+        log.info('twee2sam: {0} files unpacked'.format(count))
+        return
+
+    # Watching is just a sequence of incremental builds
+    if opts.watch:
+        opts.incremental = True
+    builder = watch if opts.watch else build
+
+    if opts.cprofile:
+        # For digging deeper than --profile does; the dump can be read with the pstats module
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(builder, opts)
+        finally:
+            profile.dump_stats(opts.cprofile)
+    else:
+        builder(opts)
+
+
+
+# How often --watch looks for changes, in seconds
+WATCH_INTERVAL = 0.25
+
+class WatchSession(object):
+    """What --watch keeps in memory from one build to the next"""
+
+    def __init__(self):
+        self.parser = None
+        self.manifest = None
+        self.assets = []
+
+def watch(opts):
+    """Rebuilds the story whenever a source or an asset changes, until interrupted"""
+    session = WatchSession()
+    snapshot = None
+    try:
+        while True:
+            current = watched_files(opts, session)
+            if current != snapshot:
+                start = time.time()
+                try:
+                    build(opts, session)
+                    log.info('twee2sam: built in {0:.2f}s; watching for changes'.format(time.time() - start))
+                except (SystemExit, IOError, OSError) as e:
+                    if not isinstance(e, SystemExit):
+                        log.error('twee2sam: {0}'.format(e))
+                    log.info('twee2sam: the build failed; watching for changes')
+                    # Whatever was kept may be half updated; the next build starts again from the files
+                    session.manifest = None
+
+                # The files changed while building will be seen on the next round; the newly referenced assets are taken as they are now
+                snapshot = dict((path, current.get(path) or file_signature(path)) for path in watched_paths(opts, session))
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        log.info('twee2sam: stopped watching')
+
+def watched_paths(opts, session):
+    paths = glob.glob(opts.sources)
+    if opts.merge:
+        paths.append(opts.merge)
+    if paths:
+        src_dir = os.path.dirname(paths[0])
+        paths.extend(os.path.join(src_dir, asset) for asset in session.assets)
+    return paths
+
+def watched_files(opts, session):
+    """Maps each file the build depends on to its size and modification time"""
+    return dict((path, file_signature(path)) for path in watched_paths(opts, session))
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+
+# Where each job of a batch logs to, within its destination
+JOB_LOG_NAME = 'twee2sam.log'
+
+class JobFormatter(logging.Formatter):
+    """Starts the messages logged while a job of a batch runs with the name of the job"""
+
+    def __init__(self, formatter=None):
+        logging.Formatter.__init__(self)
+        self.formatter = formatter or logging.Formatter()
+
+    def format(self, record):
+        text = self.formatter.format(record)
+        job = getattr(record, 'job', None)
+        return text if job is None else u'[{0}] {1}'.format(job, text)
+
+class JobLog(object):
+    """While a job of a batch runs, tags what's logged with the name of the job, copies it into a log of the job's own, and counts the warnings and errors"""
+
+    def __init__(self, job, path):
+        self.job = job
+        self.path = path
+        self.warnings = 0
+        self.errors = 0
+
+    def filter(self, record):
+        record.job = self.job
+        if record.levelno >= logging.ERROR:
+            self.errors += 1
+        elif record.levelno >= logging.WARNING:
+            self.warnings += 1
+        return True
+
+    def __enter__(self):
+        self.handler = logging.FileHandler(self.path, 'w', encoding="utf-8")
+        self.handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        log.addFilter(self)
+        log.addHandler(self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        log.removeHandler(self.handler)
+        log.removeFilter(self)
+        self.handler.close()
+
+def run_batch(opts):
+    """Compiles every story in the jobs file within this process, or over a process pool, and reports on them all at the end"""
+    try:
+        jobs = [(job.name, job_options(job)) for job in twbatch.read_jobs(opts.batch)]
+    except (IOError, twbatch.BatchError) as e:
+        log.error('twee2sam: can\'t run the batch: {0}'.format(e))
+        sys.exit(2)
 
-    # read in a file to be merged
+    root = logging.getLogger()
+    for handler in root.handlers:
+        handler.setFormatter(JobFormatter(handler.formatter))
+
+    start = time.time()
+    if opts.jobs > 1 and len(jobs) > 1:
+        # The workers can't have pools of their own, so each job compiles its passages by itself
+        for name, job_opts in jobs:
+            job_opts.jobs = 1
+
+        pool = multiprocessing.Pool(min(opts.jobs, len(jobs)), _init_batch_worker, (log.level,))
+        try:
+            results = pool.map(run_job, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_job(job) for job in jobs]
+
+    report_batch(results, time.time() - start)
+    if not all(succeeded for name, succeeded, seconds, warnings, errors in results):
+        sys.exit(2)
 
+def job_options(job):
+    """Parses the options of a job of a batch; its paths are taken from the directory of the jobs file"""
+    try:
+        opts = option_parser().parse_args(job.args)
+    except SystemExit:
+        raise twbatch.BatchError(u'job "{0}" has invalid options: {1}'.format(job.name, u' '.join(job.args)))
+
+    if opts.batch or opts.watch:
+        raise twbatch.BatchError(u'job "{0}" can\'t use --batch or --watch'.format(job.name))
+
+    for name in ('sources', 'destination', 'merge', 'ast_cache', 'cprofile'):
+        setattr(opts, name, job.path(getattr(opts, name)))
+    return opts
+
+def run_job(job):
+    """Runs a job of a batch, logging into its destination; returns (name, succeeded, seconds, warnings, errors)"""
+    name, opts = job
+    start = time.time()
+    succeeded = False
+    job_log = JobLog(name, os.path.join(opts.destination, JOB_LOG_NAME))
+    try:
+        if not os.path.exists(opts.destination):
+            os.makedirs(opts.destination)
+        with job_log:
+            try:
+                run(opts)
+                succeeded = True
+            except SystemExit:
+                # Whatever stopped the build was logged already
+                pass
+            except Exception:
+                # A job going wrong mustn't take the others with it
+                log.exception(u'twee2sam: the job failed')
+    except (IOError, OSError) as e:
+        log.error(u'twee2sam: [{0}] can\'t write into "{1}": {2}'.format(name, opts.destination, e))
+        job_log.errors += 1
+
+    return name, succeeded, time.time() - start, job_log.warnings, job_log.errors
+
+def _init_batch_worker(level):
+    # Forked workers keep the handlers they had; spawned ones start without any
+    root = logging.getLogger()
+    if not root.handlers:
+        console = logging.StreamHandler()
+        console.setFormatter(JobFormatter(logging.Formatter('%(levelname)s: %(message)s')))
+        root.addHandler(console)
+    log.setLevel(level)
+
+def report_batch(results, elapsed):
+    """Logs how each job of the batch went, and how the whole batch did"""
+    for name, succeeded, seconds, warnings, errors in results:
+        log.info(u'twee2sam: batch: "{0}" {1} in {2:.2f}s, {3} warnings, {4} errors'.format(
+            name, 'done' if succeeded else 'FAILED', seconds, warnings, errors))
+
+    failed = [name for name, succeeded, seconds, warnings, errors in results if not succeeded]
+    log.info('twee2sam: batch: {0} of {1} jobs done in {2:.2f}s, {3:.2f}s of it spent on the jobs'.format(
+        len(results) - len(failed), len(results), elapsed, sum(seconds for name, succeeded, seconds, warnings, errors in results)))
+    if failed:
+        log.error(u'twee2sam: batch: failed: {0}'.format(u', '.join(u'"{0}"'.format(name) for name in failed)))
+
+
+
+def build(opts, session=None, tiddlers=None, output=None, src_dir=None):
+    """Compiles the story as told by the command line options
+
+    In --watch mode, the session carries the parsed passages and the manifest over from the previous build.
+    compile_story() hands the passages, the output and the directory of the assets over instead.
+    With --profile, returns the profiler's report.
+    """
+
+    # With --profile, records where the time goes
+    profiler = Profiler(opts.profile)
+
+    # read source files; they're only read as they're parsed, so it all counts as parsing
+
+    profiler.phase('parse')
+
+    if tiddlers is None:
+        sources = glob.glob(opts.sources)
+
+        if not sources:
+            log.error('twee2sam: no source files specified\n')
+            sys.exit(2)
+
+        src_dir = os.path.dirname(sources[0])
+        tiddlers = itertools.chain(*[read_twee(source) for source in sources])
+
+    # read in a file to be merged; only this needs the TiddlyWiki from the tw module
+
+    merged = []
     if opts.merge:
+        from tiddlywiki import TiddlyWiki
+        tw = TiddlyWiki(opts.author)
         with io.open(opts.merge, encoding="utf-8-sig") as f:
             tw.addHtml(f.read())
+        merged = tw.tiddlers.values()
 
-    # read source files
-
-    sources = glob.glob(opts.sources)
+    #
+    # Parse the files, passage by passage, while they're read
+    #
 
-    if not sources:
-        logging.error('twee2sam: no source files specified\n')
+    # With --ast-cache, unchanged passages are loaded from the cache instead of being parsed
+    ast_cache = AstCache(opts.ast_cache) if opts.ast_cache else None
+
+    twp = TwParser(itertools.chain(merged, tiddlers), opts.jobs, profiler, session and session.parser, ast_cache)
+    if session:
+        session.parser = twp
+    if session or ast_cache:
+        log.debug('twee2sam: {0} of {1} passages parsed; the rest were unchanged'.format(twp.reparsed, len(twp.passages)))
+
+    profiler.phase('validate')
+
+    # 'passages' has every passage the compiled story needs, while only the ones in 'scripts' get scripts of their own;
+    # with --strip-unreachable, those are just the passages that can be reached from 'Start', and the ones they display.
+    passages = scripts = twp.passages
+    if opts.strip_unreachable and 'Start' in twp.passages:
+        reachable, displayed = find_reachable_passages(twp.passages)
+        # Kept in the order they were read, so that the numbering doesn't depend on how the sets are hashed
+        scripts = dict((title, passage) for title, passage in twp.passages.items() if title in reachable)
+        passages = dict((title, passage) for title, passage in twp.passages.items() if title in reachable or title in displayed)
+
+        dropped = sorted(set(twp.passages) - reachable)
+        log.info('twee2sam: {0} of {1} passages can\'t be reached from "Start" and get no scripts'.format(len(dropped), len(twp.passages)))
+        for title in dropped:
+            log.info('twee2sam: unreachable: "{0}"{1}'.format(title, ' (only displayed)' if title in displayed else ''))
+
+    # Reports every broken target at once, before anything gets written
+    dangling = find_dangling_targets(passages)
+    for title, kind, target in dangling:
+        log.error('twee2sam: {0} on "{1}" points to a nonexisting passage: "{2}"'.format(kind, title, target))
+
+    cycles = find_display_cycles(passages) if not dangling else []
+    for cycle in cycles:
+        log.error('twee2sam: passages display each other endlessly: {0}'.format(' -> '.join('"%s"' % title for title in cycle)))
+
+    if dangling or cycles:
         sys.exit(2)
 
-    for source in sources:
-        with io.open(source, encoding="utf-8-sig") as f:
-            tw.addTwee(f.read())
-
-    src_dir = os.path.dirname(sources[0])
+    # 'Start' _must_ be the first script
+    if not 'Start' in scripts:
+        log.error('twee2sam: "Start" passage not found.\n')
+        sys.exit(2)
 
     #
-    # Parse the file
+    # Load the manifest of the previous build
     #
 
-    twp = TwParser(tw)
+    profiler.phase('plan')
+
+    if session and session.manifest:
+        manifest = session.manifest
+        loaded = True
+    else:
+        manifest = BuildManifest(opts.destination)
+        loaded = manifest.load()
+    incremental = opts.incremental and loaded and manifest.compiler == __version__
+
+    # The scripts kept in a pack aren't the ones kept in the directory, so switching between them takes a full rebuild
+    output_kind = 'pack' if opts.pack else 'directory'
+    if incremental and manifest.output != output_kind:
+        log.info('twee2sam: the previous build didn\'t write a {0}; doing a full rebuild'.format(output_kind))
+        incremental = False
+
+    removed = []
+    if incremental:
+        # Passage numbers and asset indexes must stay stable for the kept scripts to remain valid
+        removed = [title for title in manifest.passages if not title in scripts]
+        images = set()
+        music = set()
+        for passage in passages.values():
+            for cmd in iter_commands(passage.commands):
+                if cmd.kind == 'image':
+                    images.add(cmd.path)
+                elif cmd.kind == 'music':
+                    music.add(cmd.path)
+
+        if not images.issuperset(manifest.images) or not music.issuperset(manifest.music):
+            log.info('twee2sam: assets were removed; doing a full rebuild')
+            incremental = False
+            removed = []
+
+    if not incremental:
+        manifest.passages = {}
 
 
     #
     # Number the passages
     #
 
-    passage_indexes = {}
+    passage_indexes = manifest.passage_indexes() if incremental else {}
+
+    # The numbers of removed passages are handed out again, lowest first
+    free_indexes = sorted((passage_indexes.pop(title) for title in removed), reverse=True)
+    for title in removed:
+        del manifest.passages[title]
 
     def process_passage_index(passage):
         global next_seq
 
         if not passage.title in passage_indexes:
-            passage_indexes[passage.title] = process_passage_index.next_seq
-            process_passage_index.next_seq += 1
-
-    process_passage_index.next_seq = 0
+            if free_indexes:
+                passage_indexes[passage.title] = free_indexes.pop()
+            else:
+                passage_indexes[passage.title] = process_passage_index.next_seq
+                process_passage_index.next_seq += 1
 
-    # 'Start' _must_ be the first script
-    if not 'Start' in twp.passages:
-        logging.error('twee2sam: "Start" passage not found.\n')
-        sys.exit(2)
+    process_passage_index.next_seq = len(passage_indexes) + len(free_indexes)
 
-    process_passage_index(twp.passages['Start'])
-    for passage in twp.passages.values():
+    process_passage_index(scripts['Start'])
+    for passage in scripts.values():
         process_passage_index(passage)
 
+    # If more passages were removed than added, the last ones are moved into the gaps; whatever links to them gets regenerated
+    holes = sorted(index for index in free_indexes if index < len(passage_indexes))
+    last = sorted((title for title, index in passage_indexes.items() if index >= len(passage_indexes)), key=passage_indexes.get)
+    for title, index in zip(last, holes):
+        passage_indexes[title] = index
+        manifest.passages[title]['index'] = index
+
     #
     # Generate the file list
     #
     passage_order = [psg for psg, idx in sorted(passage_indexes.items(), key=itemgetter(1))]
 
+    # With --display subroutine, the displayed passages get scripts of their own, called where they're displayed
+    subroutine_indexes = {}
+    if opts.display == 'subroutine':
+        for title in find_display_subroutines(passages):
+            subroutine_indexes[title] = len(passage_order) + len(subroutine_indexes)
+
 
     def name_to_identifier(s):
         return re.sub(r'[^0-9A-Za-z]', '_', s)
@@ -93,13 +479,66 @@ def main (argv):
     def script_name(s):
         return name_to_identifier(s) + '.twsam'
 
-    if not os.path.exists(opts.destination):
-        os.makedirs(opts.destination)
-    with io.open(os.path.join(opts.destination, 'Script.list.txt'), 'w', encoding="utf-8") as f_list:
-        for passage_name in passage_order:
-            passage = twp.passages[passage_name]
-            f_list.write(u"%s" % script_name(passage.title))
-            f_list.write(u'\n')
+    def subroutine_name(s):
+        return name_to_identifier(s) + '.display.twsam'
+
+    def phrase_name(i):
+        return '{0}.phrase.twsam'.format(i)
+
+    # With --compress-text, the phrases the story repeats the most get printed by scripts of their own, after the subroutines
+    phrases = None
+    if opts.compress_text:
+        phrases = PhraseTable(find_phrases(story_texts(passages)), len(passage_order) + len(subroutine_indexes))
+
+    def shared_name(i):
+        return '{0}.shared.twsam'.format(i)
+
+    # With --dedup, the strings and menus many scripts print get scripts of their own, after the phrases
+    called = find_call_targets(passages)
+
+    shared = None
+    if opts.dedup:
+        shared = find_shared_scripts(scripts, passages, subroutine_indexes, called, opts.dedup_threshold,
+                                     len(passage_order) + len(subroutine_indexes) + len(phrases or ()))
+
+    def table_name(i):
+        return '{0}.jump.twsam'.format(i)
+
+    # With --menu-mode table, the menus jump through the scripts reading and writing their slots, after the shared scripts
+    tables = None
+    if opts.menu_mode == 'table':
+        tables = JumpTables([menu_links(scripts[title], passages, subroutine_indexes) for title in passage_order if not title in called],
+                            len(passage_order) + len(subroutine_indexes) + len(phrases or ()) + len(shared or ()))
+
+    if output is None:
+        if not os.path.exists(opts.destination):
+            os.makedirs(opts.destination)
+
+        # With --pack, the scripts and lists are kept in memory and written into a single file at the end
+        if opts.pack:
+            output = PackOutput(os.path.join(opts.destination, twpack.PACK_NAME), incremental)
+        else:
+            output = DirectoryOutput(opts.destination)
+
+    script_list = [u"%s\n" % script_name(passage_name) for passage_name in passage_order]
+    script_list.extend(u"%s\n" % subroutine_name(title) for title in sorted(subroutine_indexes, key=subroutine_indexes.get))
+    if phrases:
+        script_list.extend(u"%s\n" % phrase_name(i) for i in range(len(phrases)))
+    if shared:
+        script_list.extend(u"%s\n" % shared_name(i) for i in range(len(shared)))
+    if tables:
+        script_list.extend(u"%s\n" % table_name(i) for i in range(len(tables)))
+    output.write('Script.list.txt', u''.join(script_list))
+
+    # A reused pack may still have subroutines, phrases, shared scripts or jump scripts the story doesn't need anymore
+    if isinstance(output, PackOutput):
+        output.keep_scripts(set(name.strip() for name in script_list))
+
+    # Leaves no scripts behind for passages that are gone
+    current_scripts = set(script_name(title) for title in scripts)
+    for title in removed:
+        if not script_name(title) in current_scripts:
+            output.remove(script_name(title))
 
 
     #
@@ -111,199 +550,125 @@ def main (argv):
     # C and above are available
     variables = VariableFactory(2)
 
-    image_list = []
-    music_list = []
-    for passage in twp.passages.values():
-        with io.open(os.path.join(opts.destination, script_name(passage.title)), 'w', encoding="utf-8") as script:
-
-            def check_print():
-                if check_print.pending:
-                    script.write(u'!\n')
-                    check_print.in_buffer = 0
-                    check_print.pending = False
-
-            check_print.pending = False
-            check_print.in_buffer = 0
-
-            def warning(msg):
-                logging.warning("Warning on \'{0}\': {1}".format(passage.title, msg))
-
-            def out_string(msg):
-                MAX_LEN = 512
-                # go through the string and replace characters
-                msg = ''.join(map(lambda x: {'"': "'", '[': '{', ']':'}'}[x] if x in ('"','[','{') else x, msg))
-                msg_len = len(msg)
-
-                # Checks for buffer overflow
-                if check_print.in_buffer + msg_len > MAX_LEN - 1:
-                    warning("The text exceeds the maximum buffer size; try to intersperse the text with some <<pause>> macros")
-                    remaining = max(0, MAX_LEN - 1 -  check_print.in_buffer)
-                    msg = msg[:remaining]
-
-                script.write(u'"{0}"'.format(msg))
-                script.write(u'\n')
-
-                check_print.in_buffer += len(msg)
-
-            def out_set(cmd):
-                out_expr(cmd.expr)
-                script.write(u' ')
-                target = variables.set_var(cmd.target)
-                script.write(u"%s\n" % target)
-
-            def out_if(cmd):
-                out_expr(cmd.expr)
-                script.write(u'[\n')
-                process_command_list(cmd.children, True)
-                script.write(u' 0]\n')
-
-            def out_print(cmd):
-                # print a numeric qvariable
-                out_expr(cmd.expr)
-                script.write(u'"\#"')
-
-            def out_expr(expr):
-                def var_locator(name):
-                    return variables.get_var(name).replace(':', '')
-                generated = twexpression.to_sam(expr, var_locator = var_locator)
-                script.write(u"%s" % generated)
-
-	    def out_call(cmd):
-                call_target = None
-                for k in passage_indexes.keys():
-                    if cmd.target == k:
-                        call_target = passage_indexes[k]
-                if call_target:
-                    script.write(u"%s" % call_target)
-                    script.write(u'c\n')
-
-            def out_jump(cmd):
-                call_target = None
-                for k in passage_indexes.keys():
-                    if cmd.target == k:
-                        call_target = passage_indexes[k]
-                if call_target:
-                    script.write(u"%s" % call_target)
-                    script.write(u'j\n')
-			
-			
-	    # Outputs all the text
-
-            links = []
-
-            def register_link(cmd, is_conditional):
-                temp_var = variables.new_temp_var() if is_conditional else None
-                links.append((cmd, temp_var))
-                if temp_var:
-                    script.write(u'1%s' % variables.set_var(temp_var))
-
-            def process_command_list(commands, is_conditional=False):
-                for cmd in commands:
-                    if cmd.kind == 'text':
-                        text = cmd.text.strip()
-                        if text:
-                            out_string(cmd.text)
-                            check_print.pending = True
-                    elif cmd.kind == 'print':
-                        out_print(cmd)
-                    elif cmd.kind == 'image':
-                        check_print()
-                        if not cmd.path in image_list:
-                            image_list.append(cmd.path)
-                        script.write(u'{0}i\n'.format(image_list.index(cmd.path)))
-                    elif cmd.kind == 'link':
-                        register_link(cmd, is_conditional)
-                        out_string(cmd.actual_label())
-                    elif cmd.kind == 'list':
-                        for lcmd in cmd.children:
-                            if lcmd.kind == 'link':
-                                register_link(lcmd, is_conditional)
-                    elif cmd.kind == 'pause':
-                        check_print.pending = True
-                        check_print()
-                    elif cmd.kind == 'set':
-                        out_set(cmd)
-                    elif cmd.kind == 'if':
-                        out_if(cmd)
-                    elif cmd.kind == 'call':
-                        out_call(cmd)
-                    elif cmd.kind == 'jump':
-                        out_jump(cmd)
-                    elif cmd.kind == 'return':
-                        script.write(u'$\n')
-                    elif cmd.kind == 'music':
-                        if not cmd.path in music_list:
-                            music_list.append(cmd.path)
-                        script.write(u'{0}m\n'.format(music_list.index(cmd.path)))
-                    elif cmd.kind == 'display':
-                        try:
-                            target = twp.passages[cmd.target]
-                        except KeyError:
-                            logging.error("Display macro target passage {0} not found!".format(cmd.target), file=sys.stderr)
-                            return
-                        process_command_list(target.commands)
-
-            process_command_list(passage.commands)
-
-            check_print()
-
-            # Builds the menu from the links
-
-            if links:
-                # Outputs the options separated by line breaks, max 28 chars per line
-                for link, temp_var in links:
-                    if temp_var:
-                        script.write(u'{0}['.format(variables.get_var(temp_var)))
-
-                    out_string(link.actual_label()[:28] + '\n')
+    image_list = AssetList()
+    music_list = AssetList()
+
+    if incremental:
+        variables.restore(manifest.variables)
+        image_list.extend(manifest.images)
+        music_list.extend(manifest.music)
+
+    # The variables used the most get the single-letter references; the kept scripts keep the ones they had
+    usage = count_variable_uses(scripts, passages, called)
+    uses = dict(usage.uses)
+    if tables:
+        uses.update(tables.uses)
+    variables.allocate(uses)
+    for name in usage.never_used():
+        log.warning('twee2sam: variable "${0}" is set but never used'.format(name))
+    for name in usage.never_set():
+        log.warning('twee2sam: variable "${0}" is used but never set'.format(name))
+
+    compiler = ScriptCompiler(passages, passage_indexes, variables, image_list, music_list, subroutine_indexes, called, phrases, shared, tables)
+
+    # Works out which scripts need to be (re)generated
+    pending = []
+    for passage in scripts.values():
+        if incremental and output.exists(script_name(passage.title)):
+            key = passage_key(passage, compiler)
+            if manifest.is_current(passage.title, key):
+                continue
+
+        pending.append(passage)
+
+    profiler.phase('scripts')
+
+    def generate_serially():
+        for passage in pending:
+            with profiler.passage(passage.title, 'codegen'):
+                generated = compiler.generate_script(passage)
+            yield passage, generated
+
+    if opts.jobs > 1:
+        scripts = generate_scripts_in_parallel(pending, compiler, opts.jobs)
+    else:
+        scripts = generate_serially()
+
+    for passage, generated in scripts:
+        with profiler.passage(passage.title, 'write'):
+            output.write(script_name(passage.title), generated)
+
+        # The key is taken after the generation, so that it includes the variables it allocated
+        if opts.incremental:
+            key = passage_key(passage, compiler)
+            manifest.record(passage.title, passage_indexes[passage.title], key)
+
+    # The subroutines are cheap, so they're always regenerated
+    for title in sorted(subroutine_indexes, key=subroutine_indexes.get):
+        output.write(subroutine_name(title), compiler.generate_subroutine(title))
+
+    if phrases:
+        for i, phrase in enumerate(phrases.phrases):
+            output.write(phrase_name(i), phrases.script(phrase))
+        report_compression(compiler.text_stats, phrases)
+
+    if shared:
+        codes = compiler.generate_shared_scripts()
+        for i, code in enumerate(codes):
+            output.write(shared_name(i), code)
+        report_sharing(compiler.shared_uses, shared, codes)
+
+    if tables:
+        for i, code in enumerate(compiler.generate_jump_scripts()):
+            output.write(table_name(i), code)
+        report_tables(tables)
 
-                    if temp_var:
-                        script.write(u'0]\n')
 
-                script.write(u'?A.\n')
-                check_print.in_buffer = 0
-
-                # Outputs the menu destinations
-                script.write(u'0B.\n');
-
-                for link, temp_var in links:
-                    if temp_var:
-                        script.write(u'{0}['.format(variables.get_var(temp_var)))
+    #
+    # Function to copy the files on a list and generate a list file
+    #
+    copier = AssetCopier(opts.asset_check, opts.hardlink_assets)
 
-                    if not link.target in passage_indexes:
-                        # TODO: Create a better exception
-                        raise BaseException('Link points to a nonexisting passage: "{0}"'.format(link.target))
+    def copy_and_build_list(list_file_name, file_list, item_extension, item_suffix = '', empty_item = 'blank'):
+        copies = []
+        items = []
+        for file_path in file_list:
+            item_name = name_to_identifier(os.path.splitext(os.path.basename(file_path))[0])
+            items.append(u"%s%s\n" % (item_name, item_suffix))
+            copies.append((os.path.join(src_dir or '', file_path), '%s.%s' % (item_name, item_extension)))
 
-                    script.write(u'A:B:=[{0}j]'.format(passage_indexes[link.target]))
-                    script.write(u'B:1+B.\n')
+        if not file_list:
+            items.append(u"%s%s\n" % (empty_item, item_suffix))
 
-                    if temp_var:
-                        script.write(u'0]\n')
+        output.write(list_file_name, u''.join(items))
 
-            else:
-                # No links? Generates an infinite loop.
-                script.write(u'1[1]\n')
+        # Unchanged assets are left alone, so that whatever processes them downstream sees them as unchanged too
+        output.copy_assets(copies, copier)
 
 
 
     #
-    # Function to copy the files on a list and generate a list file
+    # Checks the images against what SAM can display; unchanged images are never analysed again
     #
-    def copy_and_build_list(list_file_name, file_list, item_extension, item_suffix = '', empty_item = 'blank'):
-        with io.open(os.path.join(opts.destination, list_file_name), 'w', encoding="utf-8") as list_file:
-            for file_path in file_list:
-                item_name = name_to_identifier(os.path.splitext(os.path.basename(file_path))[0])
-                list_file.write("%s%s\n" % (item_name, item_suffix))
-                shutil.copyfile(os.path.join(src_dir, file_path), os.path.join(opts.destination, '%s.%s' % (item_name, item_extension)))
+    profiler.phase('images')
 
-            if not file_list:
-                list_file.write(u"%s%s\n" % (empty_item, item_suffix))
+    if not opts.skip_image_check:
+        checker = ImageChecker(os.path.join(opts.destination, twimages.CACHE_NAME) if opts.destination else None)
+        for image_path in image_list:
+            report = checker.check(os.path.join(src_dir or '', image_path))
+            log.info('twee2sam: image "{0}": {1}'.format(image_path, describe_report(report)))
+            for error in report['errors']:
+                log.warning('twee2sam: image "{0}": {1}'.format(image_path, error))
+        checker.save()
+        log.debug('twee2sam: {0} of {1} images analysed; the rest came from the cache'.format(checker.analysed, len(image_list)))
 
 
 
     #
     # Copy images and builds the image list
     #
+    profiler.phase('assets')
+
     copy_and_build_list('Images.txt', image_list, 'png')
 
 
@@ -313,6 +678,985 @@ def main (argv):
     #
     copy_and_build_list('Music.list.txt', music_list, 'epsgmod', '.epsgmod', 'empty')
 
+    log.info('twee2sam: {0} assets copied, {1} already up to date'.format(copier.copied, copier.skipped))
+
+
+
+    # Only now does a pack get written
+    profiler.phase('output')
+
+    output.close()
+
+    #
+    # Saves the manifest for the next incremental build
+    #
+    profiler.phase('manifest')
+
+    if opts.incremental:
+        manifest.compiler = __version__
+        manifest.output = output_kind
+        manifest.variables = variables.state()
+        manifest.images = image_list.paths
+        manifest.music = music_list.paths
+        manifest.save()
+    elif manifest.path and os.path.exists(manifest.path):
+        # A full build may have moved things around, so the old manifest can't be trusted anymore
+        os.remove(manifest.path)
+
+    if session:
+        session.manifest = manifest
+        session.assets = image_list.paths + music_list.paths
+
+    for name, info in sorted(twexpression.cache_info().items()):
+        log.debug('twee2sam: expression {0} cache: {1} hits, {2} misses'.format(name, info.hits, info.misses))
+
+    if opts.profile:
+        profiler.finish()
+        if opts.destination:
+            profiler.save(os.path.join(opts.destination, twprofile.REPORT_NAME))
+        for line in profiler.summary():
+            log.info('twee2sam: profile: {0}'.format(line))
+        return profiler.report()
+
+
+
+#
+# Compiling from other programs, without going through the command line or the disk
+#
+
+# Options that only make sense on the command line
+COMMAND_LINE_OPTIONS = ('sources', 'destination', 'incremental', 'watch', 'pack', 'unpack', 'batch', 'cprofile')
+
+class Diagnostics(logging.Handler):
+    """Collects the warnings and errors of a build
+
+    Only what's logged from the thread that created it is collected, so that builds running side by side keep their own.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.thread = threading.current_thread().ident
+        self.records = []
+
+    def filter(self, record):
+        return record.thread == self.thread and logging.Handler.filter(self, record)
+
+    def emit(self, record):
+        self.records.append((record.levelname, record.getMessage()))
+
+class CompileResult(object):
+    """What compile_story() produced
+
+    'scripts' and 'lists' map the names of the generated files to their texts; they're only there
+    for the outputs that keep the files in memory. 'diagnostics' has a (level, message) pair for
+    each warning and error. With the 'profile' option, 'profile' has the profiler's report.
+    """
+
+    def __init__(self, output, diagnostics, succeeded, profile=None):
+        self.output = output
+        self.diagnostics = diagnostics
+        self.succeeded = succeeded
+        self.profile = profile
+        files = getattr(output, 'files', {})
+        self.scripts = dict((name, text) for name, text in files.items() if name.endswith('.twsam'))
+        self.lists = dict((name, text) for name, text in files.items() if not name.endswith('.twsam'))
+
+    @property
+    def errors(self):
+        return [message for level, message in self.diagnostics if level in ('ERROR', 'CRITICAL')]
+
+def compile_story(sources, options=None, output=None, src_dir=None):
+    """Compiles twee source into SAM scripts, in this process, and returns a CompileResult
+
+    'sources' is the twee text, or a list of texts. 'options' maps the command line options, such as
+    'display' or 'menu_mode', to their values. The files go to the output, an in-memory MemoryOutput
+    unless a DirectoryOutput, a ZipOutput or anything with the same methods is given. The images and
+    music are taken from 'src_dir'; without it, the images aren't checked.
+    """
+    opts = option_parser().parse_args([])
+    for name, value in (options or {}).items():
+        name = name.replace('-', '_')
+        if not hasattr(opts, name) or name in COMMAND_LINE_OPTIONS:
+            raise ValueError('compile_story() has no "{0}" option'.format(name))
+        setattr(opts, name, value)
+    if src_dir is None:
+        opts.skip_image_check = True
+
+    if isinstance(sources, (type(u''), str)):
+        sources = [sources]
+    tiddlers = itertools.chain(*[parse_twee(source) for source in sources])
+
+    if output is None:
+        output = MemoryOutput()
+
+    diagnostics = Diagnostics()
+    log.addHandler(diagnostics)
+    profile = None
+    try:
+        profile = build(opts, tiddlers=tiddlers, output=output, src_dir=src_dir)
+        succeeded = True
+    except SystemExit:
+        # The build has logged why it stopped
+        succeeded = False
+    finally:
+        log.removeHandler(diagnostics)
+
+    return CompileResult(output, diagnostics.records, succeeded, profile)
+
+
+
+# Size of SAM's text buffer
+MAX_TEXT_LEN = 512
+
+# Operations a compiled fragment is made of
+OP_CODE, OP_STRING, OP_PENDING, OP_FLUSH, OP_LINK, OP_DISPLAY = range(6)
+
+class Fragment(object):
+    """The code compiled from a passage, kept as operations that can be replayed on any script that displays it"""
+
+    def __init__(self, title):
+        self.title = title
+        self.ops = []
+
+    def add(self, op, arg=None):
+        # Consecutive pieces of code are merged, so that they're replayed in one go
+        if op == OP_CODE and self.ops and self.ops[-1][0] == OP_CODE:
+            self.ops[-1] = (OP_CODE, self.ops[-1][1] + arg)
+        else:
+            self.ops.append((op, arg))
+
+
+
+def store_constant(value, ref):
+    """Returns the code storing a number into a variable; numbered variables need a space, or they'd run into the number"""
+    return u'{0}{1}{2}'.format(value, ' ' if ref[:1].isdigit() else '', ref)
+
+
+
+def escape_text(msg):
+    """Replaces the characters a SAM string can't hold"""
+    return msg.replace('"', "'").replace('[', '{')
+
+def story_texts(passages):
+    """Yields the strings the scripts print, as out_string gets them"""
+    for passage in passages.values():
+        for cmd in iter_commands(passage.commands):
+            if cmd.kind == 'text' and cmd.text.strip():
+                yield escape_text(cmd.text)
+            elif cmd.kind == 'link':
+                yield escape_text(cmd.actual_label())
+                yield escape_text(cmd.actual_label()[:28] + '\n')
+
+# With --dedup, a string or menu gets a script of its own when that saves at least this many bytes
+DEDUP_THRESHOLD = 32
+
+class SharedScripts(object):
+    """The strings and menus that are printed by scripts of their own, since many scripts print them
+
+    The strings are kept as out_string escapes them, and the menus by their menu_key().
+    """
+
+    def __init__(self, strings, menus, first_index):
+        self.first_index = first_index
+        self.strings = dict((string, first_index + i) for i, string in enumerate(strings))
+        self.menus = dict((menu, first_index + len(strings) + i) for i, menu in enumerate(menus))
+
+    def __len__(self):
+        return len(self.strings) + len(self.menus)
+
+    def digest(self):
+        key = hashlib.sha1(u'{0}'.format(self.first_index).encode('ascii'))
+        for item, index in sorted(list(self.strings.items()) + list(self.menus.items()), key=itemgetter(1)):
+            key.update(u'\n{0}'.format(item).encode('utf-8'))
+        return key.hexdigest()
+
+def menu_links(passage, passages, subroutine_indexes):
+    """Lists the (link, is_conditional) of the passage's menu, in the order ScriptCompiler registers them"""
+    links = []
+
+    def walk(commands, is_conditional=False):
+        for cmd in commands:
+            if cmd.kind == 'link':
+                links.append((cmd, is_conditional))
+            elif cmd.kind == 'list':
+                links.extend((lcmd, is_conditional) for lcmd in cmd.children if lcmd.kind == 'link')
+            elif cmd.kind == 'if':
+                walk(cmd.children, True)
+            elif cmd.kind == 'display' and not cmd.target in subroutine_indexes:
+                walk(passages[cmd.target].commands)
+
+    walk(passage.commands)
+    return links
+
+def menu_key(links):
+    """Returns what a menu is shared by: its labels, along with the temporaries that show the conditional ones"""
+    return tuple((link.actual_label()[:28] + '\n', temp_var) for link, temp_var in links)
+
+def find_shared_scripts(scripts, passages, subroutine_indexes, called, threshold, first_index):
+    """Counts the strings and menus the scripts print, the way ScriptCompiler writes them, and picks the ones worth sharing"""
+    strings = {}
+    menus = {}
+
+    def count(counts, item):
+        counts[item] = counts.get(item, 0) + 1
+
+    def walk(commands):
+        for cmd in commands:
+            if cmd.kind == 'text' and cmd.text.strip():
+                count(strings, escape_text(cmd.text))
+            elif cmd.kind == 'link':
+                count(strings, escape_text(cmd.actual_label()))
+            elif cmd.kind == 'if':
+                walk(cmd.children)
+            elif cmd.kind == 'display' and not cmd.target in subroutine_indexes:
+                walk(passages[cmd.target].commands)
+
+    for passage in scripts.values():
+        walk(passage.commands)
+        links = menu_links(passage, passages, subroutine_indexes)
+        # The passages that are called have temporaries of their own, so their menus can't be shared
+        if links and not passage.title in called:
+            temps = VariableFactory(0)
+            count(menus, menu_key((link, temps.new_temp_var() if is_conditional else None) for link, is_conditional in links))
+
+    # The subroutines are written once, however many scripts call them
+    for title in subroutine_indexes:
+        walk(passages[title].commands)
+
+    # What calling a shared script takes, and what the script itself takes on top of what it prints
+    call_size = len(u'{0}c\n'.format(first_index + len(strings) + len(menus)))
+    script_size = len(u'$\n') + len(u'{0}.shared.twsam\n'.format(first_index + len(strings) + len(menus)))
+
+    def saving(size, uses):
+        return uses * (size - call_size) - (size + script_size)
+
+    def string_size(string):
+        return len(string) + 3
+
+    def menu_size(menu):
+        return sum(string_size(escape_text(label)) + (len(u'X:[0]\n') if temp_var else 0) for label, temp_var in menu) + len(u'?A.\n')
+
+    # Strings that don't fit the text buffer always get cut short, so they're never shared
+    shared_strings = [string for string, uses in strings.items()
+                      if len(string) < MAX_TEXT_LEN and uses > 1 and saving(string_size(string), uses) >= threshold]
+    shared_menus = [menu for menu, uses in menus.items() if uses > 1 and saving(menu_size(menu), uses) >= threshold]
+
+    return SharedScripts(sorted(shared_strings, key=lambda string: (-saving(string_size(string), strings[string]), string)),
+                         sorted(shared_menus, key=lambda menu: (-saving(menu_size(menu), menus[menu]), [(label, temp_var or '') for label, temp_var in menu])),
+                         first_index)
+
+def report_sharing(shared_uses, shared, codes):
+    """Logs what each shared string and menu saved, and what they saved overall"""
+    uses = {}
+    for script_uses in shared_uses.values():
+        for index, count in script_uses.items():
+            uses[index] = uses.get(index, 0) + count
+
+    total = 0
+    for item, index in sorted(list(shared.strings.items()) + list(shared.menus.items()), key=itemgetter(1)):
+        if item in shared.strings:
+            size = len(item) + 3
+            what = u'string "{0}"'.format(item.strip()[:40])
+        else:
+            size = len(codes[index - shared.first_index]) - len(u'$\n')
+            what = u'menu "{0}"'.format(u'/'.join(label.strip() for label, temp_var in item)[:40])
+        saved = uses.get(index, 0) * (size - len(u'{0}c\n'.format(index))) - len(codes[index - shared.first_index])
+        total += saved
+        log.debug(u'twee2sam: shared {0}: used {1} times, {2} bytes saved'.format(what, uses.get(index, 0), saved))
+
+    log.info('twee2sam: {0} shared strings and {1} shared menus saved {2} bytes'.format(len(shared.strings), len(shared.menus), total))
+
+def menu_mode(links):
+    """Tells how a menu goes to the passage chosen with --menu-mode table
+
+    'jump' when it can only go to one passage, 'fill' when its links fill the slots as they're reached, and 'store' when it stores them all at once.
+    """
+    if any(conditional for link, conditional in links):
+        return 'fill'
+    if len(set(link.target for link, conditional in links)) > 1:
+        return 'store'
+    return 'jump'
+
+class JumpTables(object):
+    """The scripts the menus jump through with --menu-mode table, so that choosing an option takes the same time whatever the option
+
+    The passages a menu goes to are kept in slot variables, one for each option shown, and the menu jumps to the
+    script that reads the slot of the option chosen and jumps on to its passage. Where links are conditional, each
+    link fills the next slot when it's reached, by calling the script that writes it (B holds its index), so that the
+    conditions are never tested again. The scripts reading the slots come first, followed by the ones writing them.
+    """
+
+    def __init__(self, menus, first_index):
+        self.first_index = first_index
+        self.modes = {}
+        self.size = 0
+        self.uses = {}
+        for links in menus:
+            mode = menu_mode(links) if links else None
+            self.modes[mode] = self.modes.get(mode, 0) + 1
+            if mode in ('fill', 'store'):
+                self.size = max(self.size, len(links))
+                for i in range(len(links)):
+                    self.uses[self.slot(i)] = self.uses.get(self.slot(i), 0) + 2
+                if mode == 'fill':
+                    self.uses['*target'] = self.uses.get('*target', 0) + len(links)
+
+    def __len__(self):
+        return 2 * self.size
+
+    def slot(self, i):
+        return '*slot{0}'.format(i)
+
+    def first_writer(self):
+        return self.first_index + self.size
+
+    def digest(self, variables):
+        key = hashlib.sha1(u'{0} {1}'.format(self.first_index, self.size).encode('ascii'))
+        for name in ['*target'] + [self.slot(i) for i in range(self.size)]:
+            key.update(u' {0}'.format(variables.binding(name)).encode('ascii'))
+        return key.hexdigest()
+
+def report_tables(tables):
+    """Logs how the menus go to the passage chosen"""
+    log.info('twee2sam: {0} menus jump through {1} slots; {2} of them fill the slots as their links are reached, {3} menus jump straight to their only passage'.format(
+        tables.modes.get('fill', 0) + tables.modes.get('store', 0), tables.size, tables.modes.get('fill', 0), tables.modes.get('jump', 0)))
+
+def report_compression(text_stats, phrases):
+    """Logs how much the phrases saved on each script, and overall"""
+    for title, (size, compressed) in sorted(text_stats.items()):
+        if size:
+            log.debug('twee2sam: text of "{0}": {1} bytes, {2} compressed ({3:.0%})'.format(title, size, compressed, compressed / float(size)))
+
+    size = sum(size for size, compressed in text_stats.values())
+    compressed = sum(compressed for size, compressed in text_stats.values()) + phrases.size()
+    log.info('twee2sam: text of {0} scripts: {1} bytes, {2} compressed with {3} phrases ({4:.0%})'.format(
+        len(text_stats), size, compressed, len(phrases), compressed / float(size or 1)))
+
+
+
+class ScriptWriter(object):
+    """Writes a SAM script, keeping track of the text buffer and of the links for the menu"""
+
+    def __init__(self, title, variables, phrases=None, shared=None):
+        self.title = title
+        self.variables = variables
+        self.phrases = phrases
+        self.shared = shared
+        self.script = io.StringIO()
+        self.links = []
+
+        # The bytes the strings would take as they are, and the bytes they took
+        self.text_size = 0
+        self.compressed_size = 0
+
+        # How many times each shared script was called
+        self.shared_uses = {}
+
+        # With --menu-mode table, whether the links fill the slots of the menu as they're reached
+        self.fill_slots = False
+
+        self.pending = False
+        self.in_buffer = 0
+
+        # How the text buffer is used, for when the script is called as a subroutine
+        self.has_text = False
+        self.flush_first = False
+        self.flushes = 0
+        self.lead = 0
+
+    def write(self, code):
+        self.script.write(code)
+
+    def getvalue(self):
+        return self.script.getvalue()
+
+    def warning(self, msg):
+        log.warning("Warning on \'{0}\': {1}".format(self.title, msg))
+
+    def set_pending(self):
+        self.pending = True
+        self.has_text = True
+
+    def check_print(self):
+        if self.pending:
+            self.write(u'!\n')
+            if not self.flushes:
+                self.lead = self.in_buffer
+            self.flushes += 1
+            self.in_buffer = 0
+            self.pending = False
+        elif not self.has_text and not self.flushes:
+            # The caller's text would've been flushed here, had the script been inlined
+            self.flush_first = True
+
+    def text_lead(self):
+        """Returns how much text goes into the buffer before the first flush"""
+        return self.lead if self.flushes else self.in_buffer
+
+    def out_string(self, msg):
+        # go through the string and replace characters
+        msg = escape_text(msg)
+        msg_len = len(msg)
+
+        # A shared string is only called where it fits; anywhere else, it's written here and cut short as usual
+        if self.shared and msg in self.shared.strings and self.in_buffer + msg_len <= MAX_TEXT_LEN - 1:
+            self.call_shared(self.shared.strings[msg])
+            self.in_buffer += msg_len
+            return
+
+        # Checks for buffer overflow
+        if self.in_buffer + msg_len > MAX_TEXT_LEN - 1:
+            self.warning("The text exceeds the maximum buffer size; try to intersperse the text with some <<pause>> macros")
+            remaining = max(0, MAX_TEXT_LEN - 1 -  self.in_buffer)
+            msg = msg[:remaining]
+
+        if self.phrases:
+            # The phrases are printed by their scripts, straight into the same buffer
+            code = u''.join(u'{0}c\n'.format(piece) if isinstance(piece, int) else u'"{0}"\n'.format(piece)
+                            for piece in self.phrases.split(msg))
+            self.write(code)
+            self.text_size += len(msg) + 3
+            self.compressed_size += len(code)
+        else:
+            self.write(u'"{0}"'.format(msg))
+            self.write(u'\n')
+
+        self.in_buffer += len(msg)
+
+    def call_shared(self, index):
+        self.write(u'{0}c\n'.format(index))
+        self.shared_uses[index] = self.shared_uses.get(index, 0) + 1
+
+    def register_link(self, cmd, is_conditional):
+        temp_var = self.variables.new_temp_var() if is_conditional else None
+        self.links.append((cmd, temp_var))
+        if temp_var:
+            self.write(store_constant(1, self.variables.set_var(temp_var)))
+
+    def call_subroutine(self, index, sub):
+        """Calls the script written by another writer, keeping the text buffer as if it had been inlined"""
+        if self.pending and sub.flush_first:
+            self.check_print()
+        if self.in_buffer + sub.text_lead() > MAX_TEXT_LEN - 1:
+            # Flushes early instead of overflowing the buffer
+            self.set_pending()
+            self.check_print()
+        if sub.flush_first and not self.has_text and not self.flushes:
+            self.flush_first = True
+
+        self.write(u'{0}c\n'.format(index))
+
+        if sub.flushes:
+            if not self.flushes:
+                self.lead = self.in_buffer + sub.lead
+            self.flushes += sub.flushes
+            self.in_buffer = sub.in_buffer
+            self.pending = sub.pending
+        else:
+            self.in_buffer += sub.in_buffer
+            self.pending = self.pending or sub.pending
+        self.has_text = self.has_text or sub.has_text
+
+
+
+class ScriptCompiler(object):
+    """Generates the SAM scripts; a displayed passage is compiled only once, no matter how many passages display it"""
+
+    def __init__(self, passages, passage_indexes, variables, image_list, music_list, subroutine_indexes=None, called=None, phrases=None, shared=None, tables=None):
+        self.passages = passages
+        self.passage_indexes = passage_indexes
+        self.variables = variables
+        self.image_list = image_list
+        self.music_list = music_list
+
+        # Displayed passages that are called as subroutines, instead of being inlined
+        self.subroutine_indexes = subroutine_indexes or {}
+
+        # Passages other scripts <<call>>, which mustn't touch the temporaries of the scripts calling them
+        self.called = called or set()
+
+        # With text compression, the phrases that are printed by scripts of their own, and what they saved on each script
+        self.phrases = phrases
+        self.text_stats = {}
+
+        # With deduplication, the strings and menus that are printed by scripts of their own, and how often each script called them
+        self.shared = shared
+        self.shared_uses = {}
+
+        # With --menu-mode table, the scripts the menus jump through; the passages that are called still compare the options, as they may return
+        self.tables = tables
+
+        self.fragments = {}
+        self.subroutines = {}
+
+    def generate_script(self, passage):
+        """Generates the SAM script for a passage"""
+        self.variables.clear_temp_vars(passage.title if passage.title in self.called else None)
+        writer = ScriptWriter(passage.title, self.variables, self.phrases, self.shared)
+
+        mode = None
+        if self.tables and not passage.title in self.called:
+            links = menu_links(passage, self.passages, self.subroutine_indexes)
+            mode = menu_mode(links) if links else None
+            writer.fill_slots = mode == 'fill'
+
+        if passage.title in self.fragments:
+            self._replay(self.fragments[passage.title], writer)
+        else:
+            self._compile(passage, writer)
+
+        writer.check_print()
+
+        # Builds the menu from the links
+
+        variables = self.variables
+        if writer.links:
+            menu = menu_key(writer.links)
+            if self.shared and menu in self.shared.menus and writer.in_buffer + sum(len(escape_text(label)) for label, temp_var in menu) <= MAX_TEXT_LEN - 1:
+                writer.call_shared(self.shared.menus[menu])
+            else:
+                self._write_menu(writer, menu)
+            writer.in_buffer = 0
+
+            if mode == 'jump':
+                writer.write(u'{0}j\n'.format(self.passage_indexes[writer.links[0][0].target]))
+            elif mode:
+                if mode == 'store':
+                    writer.write(u''.join(store_constant(self.passage_indexes[link.target], variables.set_var(self.tables.slot(i)))
+                                          for i, (link, temp_var) in enumerate(writer.links)))
+                if all(temp_var for link, temp_var in writer.links):
+                    # Should none of the links be shown, the script ends, as it does when the options are compared
+                    writer.write(u'B:{0}>[A:{1}+j]\n'.format(self.tables.first_writer(), self.tables.first_index))
+                else:
+                    writer.write(u'A:{0}+j\n'.format(self.tables.first_index))
+            else:
+                # Outputs the menu destinations
+                writer.write(u'0B.\n');
+
+                for link, temp_var in writer.links:
+                    if temp_var:
+                        writer.write(u'{0}['.format(variables.get_var(temp_var)))
+
+                    writer.write(u'A:B:=[{0}j]'.format(self.passage_indexes[link.target]))
+                    writer.write(u'B:1+B.\n')
+
+                    if temp_var:
+                        writer.write(u'0]\n')
+
+        else:
+            # No links? Generates an infinite loop.
+            writer.write(u'1[1]\n')
+
+        if self.phrases:
+            self.text_stats[passage.title] = (writer.text_size, writer.compressed_size)
+        if writer.shared_uses:
+            self.shared_uses[passage.title] = writer.shared_uses
+
+        # Other scripts use the same temporaries, so they're cleared before the links get to set them
+        temps = [temp_var for link, temp_var in writer.links if temp_var]
+        if temps or writer.fill_slots:
+            prologue = u''.join(store_constant(0, variables.set_var(temp_var)) for temp_var in temps)
+            if writer.fill_slots:
+                # The links fill the slots from the first one
+                prologue += store_constant(self.tables.first_writer(), u'B.')
+            return prologue + u'\n' + writer.getvalue()
+
+        return writer.getvalue()
+
+    def generate_subroutine(self, title):
+        """Generates the script that's called in place of displaying the passage"""
+        sub = self._subroutine(title)
+        if sub.shared_uses:
+            self.shared_uses[u'{0} (display)'.format(title)] = sub.shared_uses
+        return sub.getvalue() + u'$\n'
+
+    def generate_shared_scripts(self):
+        """Generates the scripts of the shared strings and menus, in the order of their indexes"""
+        shared = self.shared
+        codes = []
+        for item, index in sorted(list(shared.strings.items()) + list(shared.menus.items()), key=itemgetter(1)):
+            if item in shared.strings:
+                codes.append(u'"{0}"\n$\n'.format(item))
+            else:
+                writer = ScriptWriter(u'shared menu', self.variables)
+                self._write_menu(writer, item)
+                codes.append(writer.getvalue() + u'$\n')
+        return codes
+
+    def generate_jump_scripts(self):
+        """Generates the scripts reading each slot and jumping to its passage, and then the ones writing each slot"""
+        variables = self.variables
+        tables = self.tables
+        codes = [u'{0}j\n'.format(variables.get_var(tables.slot(i))) for i in range(tables.size)]
+        codes.extend(u'{0}{1}B:1+B.\n$\n'.format(variables.get_var('*target'), variables.set_var(tables.slot(i))) for i in range(tables.size))
+        return codes
+
+    def _write_menu(self, writer, menu):
+        """Writes the options separated by line breaks, max 28 chars per line, and lets the player choose"""
+        for label, temp_var in menu:
+            if temp_var:
+                writer.write(u'{0}['.format(self.variables.get_var(temp_var)))
+
+            writer.out_string(label)
+
+            if temp_var:
+                writer.write(u'0]\n')
+
+        writer.write(u'?A.\n')
+
+    def fragment(self, title):
+        """Returns the compiled code of a passage, compiling it if needed"""
+        if title in self.fragments:
+            return self.fragments[title]
+        return self._compile(self.passages[title], None)
+
+    def _compile(self, passage, writer):
+        """Compiles the passage into a fragment; if there's a writer, the code is also written as it's compiled"""
+        fragment = Fragment(passage.title)
+
+        def emit(op, arg=None):
+            fragment.add(op, arg)
+            if writer:
+                self._apply(writer, op, arg)
+            elif op == OP_DISPLAY:
+                # Keeps the variables being allocated in the order they're used
+                self.fragment(arg)
+
+        self._compile_commands(passage.commands, emit)
+
+        self.fragments[passage.title] = fragment
+        return fragment
+
+    def _compile_commands(self, commands, emit, is_conditional=False):
+        variables = self.variables
+        image_list = self.image_list
+        music_list = self.music_list
+
+        for cmd in commands:
+            if cmd.kind == 'text':
+                text = cmd.text.strip()
+                if text:
+                    emit(OP_STRING, cmd.text)
+                    emit(OP_PENDING)
+            elif cmd.kind == 'print':
+                # print a numeric qvariable
+                emit(OP_CODE, self._expr(cmd.expr) + u'"\#"')
+            elif cmd.kind == 'image':
+                emit(OP_FLUSH)
+                emit(OP_CODE, u'{0}i\n'.format(image_list.add(cmd.path)))
+            elif cmd.kind == 'link':
+                emit(OP_LINK, (cmd, is_conditional))
+                emit(OP_STRING, cmd.actual_label())
+            elif cmd.kind == 'list':
+                for lcmd in cmd.children:
+                    if lcmd.kind == 'link':
+                        emit(OP_LINK, (lcmd, is_conditional))
+            elif cmd.kind == 'pause':
+                emit(OP_PENDING)
+                emit(OP_FLUSH)
+            elif cmd.kind == 'set':
+                code = self._expr(cmd.expr) + u' '
+                emit(OP_CODE, code + u"%s\n" % variables.set_var(cmd.target))
+            elif cmd.kind == 'if':
+                emit(OP_CODE, self._expr(cmd.expr) + u'[\n')
+                self._compile_commands(cmd.children, emit, True)
+                emit(OP_CODE, u' 0]\n')
+            elif cmd.kind == 'call':
+                emit(OP_CODE, u"%sc\n" % self.passage_indexes[cmd.target])
+            elif cmd.kind == 'jump':
+                emit(OP_CODE, u"%sj\n" % self.passage_indexes[cmd.target])
+            elif cmd.kind == 'return':
+                emit(OP_CODE, u'$\n')
+            elif cmd.kind == 'music':
+                emit(OP_CODE, u'{0}m\n'.format(music_list.add(cmd.path)))
+            elif cmd.kind == 'display':
+                emit(OP_DISPLAY, cmd.target)
+
+    def _expr(self, expr):
+        variables = self.variables
+        def var_locator(name):
+            return variables.get_var(name).replace(':', '')
+        return u"%s" % twexpression.to_sam(expr, var_locator = var_locator)
+
+    def _apply(self, writer, op, arg):
+        if op == OP_CODE:
+            writer.write(arg)
+        elif op == OP_STRING:
+            writer.out_string(arg)
+        elif op == OP_PENDING:
+            writer.set_pending()
+        elif op == OP_FLUSH:
+            writer.check_print()
+        elif op == OP_LINK:
+            writer.register_link(*arg)
+            if writer.fill_slots:
+                # Fills the next slot only when the link is reached
+                writer.write(store_constant(self.passage_indexes[arg[0].target], self.variables.set_var('*target')) + u'B:c\n')
+        elif op == OP_DISPLAY:
+            self._display(writer, arg)
+
+    def _replay(self, fragment, writer):
+        for op, arg in fragment.ops:
+            self._apply(writer, op, arg)
+
+    def _display(self, writer, title):
+        if title in self.subroutine_indexes:
+            writer.call_subroutine(self.subroutine_indexes[title], self._subroutine(title))
+        elif title in self.fragments:
+            self._replay(self.fragments[title], writer)
+        else:
+            self._compile(self.passages[title], writer)
+
+    def _subroutine(self, title):
+        """Returns the writer holding the subroutine generated for the passage"""
+        if not title in self.subroutines:
+            sub = ScriptWriter(title, self.variables, self.phrases, self.shared)
+            self._replay(self.fragment(title), sub)
+            self.subroutines[title] = sub
+        return self.subroutines[title]
+
+
+
+def allocate_script(passage, passages, variables, image_list, music_list, called=()):
+    """Allocates the variables and assets the passage's script will use, in the same order ScriptCompiler would"""
+    variables.clear_temp_vars(passage.title if passage.title in called else None)
+
+    def register_link(is_conditional):
+        if is_conditional:
+            variables.set_var(variables.new_temp_var())
+
+    def process_command_list(commands, is_conditional=False):
+        for cmd in commands:
+            if cmd.kind in ('print', 'set', 'if'):
+                for name in twexpression.variable_names(cmd.expr):
+                    variables.get_var(name)
+                if cmd.kind == 'set':
+                    variables.set_var(cmd.target)
+                elif cmd.kind == 'if':
+                    process_command_list(cmd.children, True)
+            elif cmd.kind == 'image':
+                image_list.add(cmd.path)
+            elif cmd.kind == 'link':
+                register_link(is_conditional)
+            elif cmd.kind == 'list':
+                for lcmd in cmd.children:
+                    if lcmd.kind == 'link':
+                        register_link(is_conditional)
+            elif cmd.kind == 'music':
+                music_list.add(cmd.path)
+            elif cmd.kind == 'display':
+                process_command_list(passages[cmd.target].commands)
+
+    process_command_list(passage.commands)
+
+
+
+def count_variable_uses(scripts, passages, called):
+    """Goes through every script the way allocate_script does, and returns the VariableFactory that counted the variables"""
+    usage = VariableFactory(0)
+    for passage in scripts.values():
+        allocate_script(passage, passages, usage, AssetList(), AssetList(), called)
+    return usage
+
+
+
+def find_call_targets(passages):
+    """Lists the passages that are the target of a <<call>>"""
+    called = set()
+    for passage in passages.values():
+        for cmd in iter_commands(passage.commands):
+            if cmd.kind == 'call':
+                called.add(cmd.target)
+    return called
+
+
+
+def find_dangling_targets(passages):
+    """Lists the (passage, command kind, target) of every link, call, jump or display that points to a nonexisting passage"""
+    dangling = []
+    for title in sorted(passages):
+        for cmd in iter_commands(passages[title].commands):
+            if cmd.kind in ('link', 'call', 'jump', 'display') and not cmd.target in passages:
+                dangling.append((title, cmd.kind, cmd.target))
+
+    return dangling
+
+
+
+def find_reachable_passages(passages, start='Start'):
+    """Finds the passages that can be reached from the start through links, calls and jumps, and the ones they display
+
+    Displayed passages never run on their own, but whatever they link to can be reached from the passages
+    displaying them. Returns the sets of (reachable, displayed) titles; targets that don't exist are left out.
+    """
+    reachable = set([start])
+    displayed = set()
+    pending = [start]
+    while pending:
+        included = [pending.pop()]
+        for title in included:
+            for cmd in iter_commands(passages[title].commands):
+                if not cmd.kind in ('link', 'call', 'jump', 'display') or not cmd.target in passages:
+                    continue
+                if cmd.kind == 'display':
+                    displayed.add(cmd.target)
+                    if not cmd.target in included:
+                        included.append(cmd.target)
+                elif not cmd.target in reachable:
+                    reachable.add(cmd.target)
+                    pending.append(cmd.target)
+
+    return reachable, displayed
+
+
+
+def find_display_cycles(passages):
+    """Lists the chains of <<display>> macros that lead back to the passage they started from"""
+    displayed = {}
+    for title, passage in passages.items():
+        displayed[title] = sorted(set(cmd.target for cmd in iter_commands(passage.commands) if cmd.kind == 'display'))
+
+    cycles = []
+    visited = set()
+    for root in sorted(passages):
+        if root in visited:
+            continue
+
+        # Depth-first search; 'path' holds the chain of passages being displayed
+        visited.add(root)
+        path = [root]
+        pending = [iter(displayed[root])]
+        while pending:
+            for title in pending[-1]:
+                if title in path:
+                    cycles.append(path[path.index(title):] + [title])
+                elif not title in visited:
+                    visited.add(title)
+                    path.append(title)
+                    pending.append(iter(displayed[title]))
+                break
+            else:
+                path.pop()
+                pending.pop()
+
+    return cycles
+
+
+
+def find_display_subroutines(passages):
+    """Lists the displayed passages that can be called as subroutines
+
+    Links, jumps and returns only make sense within the passage doing the displaying, so passages
+    containing them (even through another <<display>>) are always inlined.
+    """
+    must_inline = {}
+
+    def check(title):
+        if not title in must_inline:
+            must_inline[title] = False
+            for cmd in iter_commands(passages[title].commands):
+                if cmd.kind in ('link', 'jump', 'return') or (cmd.kind == 'display' and check(cmd.target)):
+                    must_inline[title] = True
+                    break
+        return must_inline[title]
+
+    displayed = set()
+    for passage in passages.values():
+        for cmd in iter_commands(passage.commands):
+            if cmd.kind == 'display':
+                displayed.add(cmd.target)
+
+    return [title for title in sorted(displayed) if not check(title)]
+
+
+
+def generate_scripts_in_parallel(pending, compiler, jobs):
+    """Generates the scripts over a process pool; the output is the same as the serial generation's"""
+
+    # Allocates everything up front, so that the workers don't have to share any mutable state
+    for passage in pending:
+        allocate_script(passage, compiler.passages, compiler.variables, compiler.image_list, compiler.music_list, compiler.called)
+
+    pool = multiprocessing.Pool(jobs, _init_script_worker, (compiler,))
+    try:
+        chunk_size = max(1, len(pending) // (jobs * 4))
+        results = pool.map(_generate_script_in_worker, [passage.title for passage in pending], chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+    scripts = []
+    for passage, (script, text_stats, shared_uses) in zip(pending, results):
+        if text_stats:
+            compiler.text_stats[passage.title] = text_stats
+        if shared_uses:
+            compiler.shared_uses[passage.title] = shared_uses
+        scripts.append(script)
+
+    return zip(pending, scripts)
+
+def _init_script_worker(compiler):
+    global _worker_compiler
+    _worker_compiler = compiler
+
+def _generate_script_in_worker(title):
+    script = _worker_compiler.generate_script(_worker_compiler.passages[title])
+    return script, _worker_compiler.text_stats.get(title), _worker_compiler.shared_uses.get(title)
+
+
+
+def passage_key(passage, compiler):
+    """Digests everything the script generated for a passage depends on"""
+    passages = compiler.passages
+    passage_indexes = compiler.passage_indexes
+    variables = compiler.variables
+    image_list = compiler.image_list
+    music_list = compiler.music_list
+
+    key = hashlib.sha1()
+
+    # Called passages get temporaries of their own
+    if passage.title in compiler.called:
+        key.update(b'called')
+
+    # The text depends on the whole story's phrases, and on where their scripts are
+    if compiler.phrases:
+        key.update(compiler.phrases.digest().encode('ascii'))
+    if compiler.shared:
+        key.update(compiler.shared.digest().encode('ascii'))
+    if compiler.tables:
+        key.update(compiler.tables.digest(variables).encode('ascii'))
+
+    # Displayed passages are inlined or called, but either way their contents count as well
+    included = [passage]
+    for psg in included:
+        key.update(psg.digest.encode('ascii'))
+        for cmd in iter_commands(psg.commands):
+            if cmd.kind in ('link', 'call', 'jump'):
+                deps = [cmd.target, passage_indexes.get(cmd.target)]
+            elif cmd.kind == 'display':
+                target = passages.get(cmd.target)
+                if target and not target in included:
+                    included.append(target)
+                deps = [cmd.target, compiler.subroutine_indexes.get(cmd.target)]
+            elif cmd.kind == 'image':
+                deps = [cmd.path, image_list.get(cmd.path)]
+            elif cmd.kind == 'music':
+                deps = [cmd.path, music_list.get(cmd.path)]
+            elif cmd.kind in ('set', 'if', 'print'):
+                names = twexpression.variable_names(cmd.expr)
+                if cmd.kind == 'set':
+                    names.append(cmd.target)
+                deps = []
+                for name in names:
+                    deps.extend([name, variables.binding(name)])
+            else:
+                continue
+
+            key.update(u'\n'.join(u'%s' % dep for dep in [cmd.kind] + deps).encode('utf-8'))
+
+    return key.hexdigest()
+
 
 
 class VariableFactory(object):
@@ -321,21 +1665,24 @@ class VariableFactory(object):
         self.next_available = first_available
 
         self.vars = {}
-        self.never_used = []
-        self.never_set = []
 
-        self.next_temp = 0;
-        self.temps = []
+        # How many times each variable is read or set, and which ones are ever read, and ever set
+        self.uses = {}
+        self.read = set()
+        self.written = set()
+
+        # Temporaries are handed out from the first one again for every script, unless the script has an owner
+        self.next_temp = 0
+        self.temp_owner = None
 
     def set_var(self, name):
         name = self._normalize_name(name)
 
         if not name in self.vars:
             self._create_var(name)
-            self.never_used.append(name)
 
-        if name in self.never_set:
-            self.never_set.remove(name)
+        self.uses[name] = self.uses.get(name, 0) + 1
+        self.written.add(name)
 
         return '{0}.'.format(self.vars[name])
 
@@ -344,24 +1691,54 @@ class VariableFactory(object):
 
         if not name in self.vars:
             self._create_var(name)
-            self.never_set.append(name)
 
-        if name in self.never_used:
-            self.never_used.remove(name)
+        self.uses[name] = self.uses.get(name, 0) + 1
+        self.read.add(name)
 
         return '{0}:'.format(self.vars[name])
 
-    def new_temp_var(self):
-        if self.next_temp >= len(self.temps):
-            self.temps.append('*temp{0}'.format(self.next_temp))
+    def allocate(self, uses):
+        """Creates the variables in order of how often they're used, so that the busiest ones get single letters
+
+        Variables that already exist keep their references.
+        """
+        for name in sorted(uses, key=lambda name: (-uses[name], name)):
+            if not name in self.vars:
+                self._create_var(name)
+
+    def never_used(self):
+        return sorted(name for name in self.written - self.read if not name.startswith('*'))
 
-        temp = self.temps[self.next_temp]
+    def never_set(self):
+        return sorted(name for name in self.read - self.written if not name.startswith('*'))
+
+    def binding(self, name):
+        """Returns the reference already allocated to the variable, if any"""
+        return self.vars.get(self._normalize_name(name))
+
+    def state(self):
+        return {
+            'vars': self.vars,
+            'next_available': self.next_available
+        }
+
+    def restore(self, state):
+        self.vars = dict(state['vars'])
+        self.next_available = state['next_available']
+
+    def new_temp_var(self):
+        if self.temp_owner is None:
+            temp = '*temp{0}'.format(self.next_temp)
+        else:
+            temp = '*{0}*temp{1}'.format(self.temp_owner, self.next_temp)
         self.next_temp += 1
 
         return temp
 
-    def clear_temp_vars(self):
+    def clear_temp_vars(self, owner=None):
+        """Starts over with the temporaries; with an owner, they're the owner's alone, and no other script uses them"""
         self.next_temp = 0
+        self.temp_owner = owner
 
     def _create_var(self, name):
         self.vars[name] = self._num_to_ref(self.next_available)
@@ -377,10 +1754,12 @@ class VariableFactory(object):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     logging.basicConfig(filename='twee2sam.log', level=logging.DEBUG)
     console = logging.StreamHandler()
     console.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(levelname)s: %(message)s')
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
+    log.setLevel(logging.DEBUG)
     main(sys.argv)